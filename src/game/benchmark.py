@@ -0,0 +1,86 @@
+"""
+Microbenchmark of the UCB child selection (MCTS_Node._best_edge) as a function of fan-out
+"""
+
+import timeit
+
+import numpy as np
+
+from mcts import MCTS_Node
+from tree_store import TreeStore
+
+
+def build_fan(fan_out, seed=0):
+    """
+    Builds a tree store holding a root with the given number of visited children (random statistics)
+
+    fan_out : number of children
+    seed : random seed for the statistics
+
+    return -> the root node
+    """
+
+    rng = np.random.default_rng(seed)
+    store = TreeStore(capacity=fan_out + 1)
+    root = store.add_node(None, 1, 2, 0, None)
+    for i in range(fan_out):
+        child = store.add_node(None, 2, 1, 1, None, parent=root, move=i)
+        store.add_edge(root, child, i)
+
+    children = np.arange(1, fan_out + 1)
+    store.visits[children] = rng.integers(1, 50, fan_out)
+    store.wins[children] = rng.integers(0, 25, fan_out)
+    store.losses[children] = rng.integers(0, 25, fan_out)
+    store.visits[root] = store.visits[children].sum()
+    return MCTS_Node._view(store, root)
+
+
+def scalar_best_child(node, C):
+    """
+    Reference selection, one np.log/np.sqrt call per child (how _best_child used to score the children)
+
+    node : the parent node
+    C : exploration parameter
+
+    return -> index of the most promising child
+    """
+
+    store = node._store
+    weights = [((store.wins[child] - store.losses[child]) / store.visits[child]) + C *
+               np.sqrt((2 * np.log(store.visits[node._index]) / store.visits[child])) for child in store.children(node._index)]
+    return np.argmax(weights)
+
+
+def bench_selection(fan_outs=(10, 100, 300, 1000, 3000), C=1.4, repeat=5):
+    """
+    Times one selection at each fan-out, vectorized and scalar
+
+    fan_outs : the numbers of children to time
+    C : exploration parameter
+    repeat : number of timing runs, the best one is kept
+
+    return -> list of (fan-out, vectorized seconds, scalar seconds) per selection
+    """
+
+    results = []
+    for fan_out in fan_outs:
+        node = build_fan(fan_out)
+        number = max(1, 20000 // fan_out)
+        vectorized = min(timeit.repeat(lambda: node._best_edge(C), number=number, repeat=repeat)) / number
+        scalar = min(timeit.repeat(lambda: scalar_best_child(node, C), number=max(1, number // 10), repeat=repeat)) / max(1, number // 10)
+        results.append((fan_out, vectorized, scalar))
+    return results
+
+
+def main():
+    """
+    Prints the selection cost table
+    """
+
+    print(f"{'fan-out':>8} {'vectorized':>12} {'scalar':>12} {'speedup':>8}")
+    for fan_out, vectorized, scalar in bench_selection():
+        print(f"{fan_out:>8} {vectorized * 1e6:>10.1f}us {scalar * 1e6:>10.1f}us {scalar / vectorized:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Bit-level helpers for the 10x10 board
+
+Every square (x, y) is mapped to bit x*10 + y of a Python int, so a set of
+squares (a piece, a players territory, the cathedral, ...) is a single 100-bit mask
+"""
+
+import numpy as np
+
+BOARD_DIMENSIONS = 10
+TOTAL_SQUARES = BOARD_DIMENSIONS * BOARD_DIMENSIONS
+FULL_MASK = (1 << TOTAL_SQUARES) - 1
+LOW_WORD_MASK = (1 << 64) - 1
+
+
+def square_index(x, y):
+    """
+    Converts board coordinates to a square index
+
+    x : row of the square
+    y : column of the square
+
+    return -> the square index (0-99)
+    """
+
+    return x * BOARD_DIMENSIONS + y
+
+
+def coords_to_mask(coords):
+    """
+    Converts a list of (x, y) coordinates to a bitmask
+
+    coords : iterable of (x, y) coordinates
+
+    return -> the bitmask of those squares
+    """
+
+    mask = 0
+    for x, y in coords:
+        mask |= 1 << (x * BOARD_DIMENSIONS + y)
+    return mask
+
+
+def iter_squares(mask):
+    """
+    Iterates over the square indices set in a bitmask (lowest index first)
+
+    mask : the bitmask
+
+    return -> generator of square indices
+    """
+
+    while mask:
+        low_bit = mask & -mask
+        yield low_bit.bit_length() - 1
+        mask ^= low_bit
+
+
+def mask_to_coords(mask):
+    """
+    Converts a bitmask to a list of (x, y) coordinates, in row-major order
+
+    mask : the bitmask
+
+    return -> list of (x, y) coordinates
+    """
+
+    return [divmod(sq, BOARD_DIMENSIONS) for sq in iter_squares(mask)]
+
+
+def _column_mask(column):
+    """
+    Builds the mask of one board column
+
+    column : the column (y coordinate)
+
+    return -> the column mask
+    """
+
+    return sum(1 << square_index(x, column) for x in range(BOARD_DIMENSIONS))
+
+
+NOT_FIRST_COLUMN = FULL_MASK & ~_column_mask(0)
+NOT_LAST_COLUMN = FULL_MASK & ~_column_mask(BOARD_DIMENSIONS - 1)
+
+
+def dilate(mask):
+    """
+    Grows a mask by one square in every direction (including diagonals)
+
+    mask : the bitmask
+
+    return -> the mask and all of its 8-neighbours
+    """
+
+    # Spread along the row (the edge masks stop squares wrapping onto the next row), then along the columns
+    row = mask | ((mask << 1) & NOT_FIRST_COLUMN) | ((mask >> 1) & NOT_LAST_COLUMN)
+    return (row | (row << BOARD_DIMENSIONS) | (row >> BOARD_DIMENSIONS)) & FULL_MASK
+
+
+def flood_fill(seed, free):
+    """
+    Finds the 8-connected area of free squares containing the seed, by dilating until nothing changes
+
+    seed : mask of the starting square(s)
+    free : mask of the squares the area can extend through
+
+    return -> mask of the area
+    """
+
+    region = seed & free
+    while True:
+        grown = dilate(region) & free
+        if grown == region:
+            return region
+        region = grown
+
+
+def enclosed_regions(free, seeds):
+    """
+    Splits the free space touching the seed squares into its connected regions
+
+    free : mask of the squares a region can extend through (everything but the walls)
+    seeds : mask of the squares to start from
+
+    return -> list of region masks, each seed square is in exactly one of them
+    """
+
+    regions = []
+    remaining = seeds & free
+    while remaining:
+        region = flood_fill(remaining & -remaining, free)
+        regions.append(region)
+        remaining &= ~region
+    return regions
+
+
+def array_to_mask(squares):
+    """
+    Converts a boolean array over the 100 squares to a bitmask
+
+    squares : boolean array, square index order
+
+    return -> the bitmask
+    """
+
+    return int.from_bytes(np.packbits(squares, bitorder='little').tobytes(), 'little')
+
+
+def split_mask(mask):
+    """
+    Splits a bitmask into the two 64 bit words used by the vectorized placement filters
+
+    mask : the bitmask
+
+    return -> (low word, high word) as np.uint64
+    """
+
+    return np.uint64(mask & LOW_WORD_MASK), np.uint64(mask >> 64)
+
+
+def shape_to_mask(shape):
+    """
+    Converts a piece shape to a mask anchored at the top left square
+
+    shape : 2d array, any entry other then 0 (or '0') is part of the piece
+
+    return -> the shape mask
+    """
+
+    mask = 0
+    for (x, y), value in np.ndenumerate(shape):
+        if value != 0 and value != '0':
+            mask |= 1 << square_index(x, y)
+    return mask
+
+
+def shape_translations(shape):
+    """
+    Finds every placement of a shape that fits on the board
+
+    shape : 2d array, any entry other then 0 (or '0') is part of the piece
+
+    return -> list of placement masks, ordered by the top left square (row-major)
+    """
+
+    shape_mask = shape_to_mask(shape)
+    n, m = shape.shape
+    return [shape_mask << square_index(i, j)
+            for i in range(BOARD_DIMENSIONS - n + 1) for j in range(BOARD_DIMENSIONS - m + 1)]
+
+
+def _build_square_rotations():
+    """
+    Builds the image of every square under the board's rotations
+
+    return -> np.int64 array (4, 100), row r maps each square to its square after r quarter turns clockwise
+    """
+
+    # A quarter turn clockwise moves (x, y) to (y, 9 - x)
+    quarter = np.array([square_index(y, BOARD_DIMENSIONS - 1 - x) for x in range(BOARD_DIMENSIONS) for y in range(BOARD_DIMENSIONS)])
+    rotations = [np.arange(TOTAL_SQUARES)]
+    for _ in range(3):
+        rotations.append(quarter[rotations[-1]])
+    return np.array(rotations)
+
+
+SQUARE_ROTATIONS = _build_square_rotations()
+
+
+def rotate_mask(mask, rotation):
+    """
+    Rotates a bitmask around the center of the board
+
+    mask : the bitmask
+    rotation : number of quarter turns clockwise (0-3)
+
+    return -> the rotated mask
+    """
+
+    squares = SQUARE_ROTATIONS[rotation]
+    rotated = 0
+    for sq in iter_squares(mask):
+        rotated |= 1 << int(squares[sq])
+    return rotated
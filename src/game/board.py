@@ -2,14 +2,25 @@
 Handles the game board, players and piece objects
 """
 
-import copy
+import bisect
+import random
+
 import numpy as np
 
+from bitboard import (BOARD_DIMENSIONS, TOTAL_SQUARES, FULL_MASK, SQUARE_ROTATIONS, coords_to_mask, iter_squares,
+                      mask_to_coords, split_mask, shape_translations, dilate, enclosed_regions, array_to_mask, rotate_mask)
+from zobrist import random_keys
+
+CATHEDRAL_ID = 12  # Value used for the cathedral in the per-square piece id array
+_MASK_BYTES = (TOTAL_SQUARES + 7) // 8
+BOARD_BYTES = TOTAL_SQUARES + 2 * _MASK_BYTES + 2  # Size of Board.to_bytes
+SAMPLE_TRIES = 32  # Draws of Board.sample_placement before it gives up
 
-class Board: 
+
+class Board:
     """
     Manages the Board - places pieces, refreshes the board state, etc
-    
+
     Board:
     0 - empty square
     positive # - player 1 piece (red)
@@ -17,6 +28,9 @@ class Board:
     r - player 1 control (red)
     b - player 2 control (black)
     c - cathedral (special square)
+
+    The board is stored as bitboards (see bitboard.py), one 100-bit mask per players pieces,
+    one per players territory and one for the cathedral, plus a per-square piece id array
     """
     def __init__(self):
         """
@@ -24,131 +38,119 @@ class Board:
 
         _board_dimensions : the dimensions of the board, in this case 10x10
         _total_squares : the total number of squares on the board
-        _board : the board
+        _pieces : piece masks for each player (index 0 for red, 1 for black)
+        _territory : controlled square masks for each player (index 0 for red, 1 for black)
+        _cathedral : mask of the cathedral squares
+        _piece_ids : signed piece number on every square (0 if no piece, CATHEDRAL_ID for the cathedral)
+        total_placed_pieces : the number of pieces placed so far
+        version : incremented every time the board changes
+        hash : Zobrist hash of the piece ids, territory and placed piece count (see zobrist.py), updated with every move
         """
 
-        self._board_dimensions = 10
-        self._total_squares = self._board_dimensions * self._board_dimensions
-        self._board = np.zeros([self._board_dimensions, self._board_dimensions], dtype=object)
+        self._board_dimensions = BOARD_DIMENSIONS
+        self._total_squares = TOTAL_SQUARES
+        self._pieces = [0, 0]
+        self._territory = [0, 0]
+        self._cathedral = 0
+        self._piece_ids = np.zeros(self._total_squares, dtype=np.int8)
+        self.total_placed_pieces = 0
+        self.version = 0
+        self.hash = self._compute_hash()
 
-    def _refresh_board_state(self, placed_piece, player_sign):
+    def _compute_hash(self):
         """
-        Used after every player turn to update the board state
-        
-        param placed_piece : the most recent placed piece
-        param player_sign : positive/negative numbers associated with each players pieces (1 for p1 or -1 for p2)
+        Computes the Zobrist hash of the board from scratch
 
-        return : any pieces that were captured
+        return -> the hash
         """
 
-        for sq in placed_piece:  # Check around every newly placed square to see if control needs to be updated
-            checked = []  # Keep track of checked squares so as not to check twice
-            
-            nx, ny = sq[0], sq[1]  # Get coordinates of the given square
-            for adj_sq in self._get_adjacent_squares(nx, ny): # Find all adjacent squares to given square
-                
-                if adj_sq in checked:
-                    continue  # Skip checking squares that have already been checked
-                
-                else:
-                    checked.append(adj_sq)
-                    adj_x, adj_y = adj_sq[0], adj_sq[1]  # Get coordinates of the adjacent square to be checked
-                    
-                    if (self._board[adj_x, adj_y] == 'c') or (self._board[adj_x, adj_y] == 'b') or (self._board[adj_x, adj_y] == 'r'): 
-                        # If a square is either the cathedral or already controlled by a player we don't need to check in that direction
-                        continue
-                    
-                    elif (int(self._board[adj_x, adj_y]) * player_sign > 0):
-                        # If a square is controlled by the player who just placed a piece we dont need to check in that direction
-                        continue
-                    
-                    else:
-                        captured_squares = self._check_if_surrounded(player_sign*-1, adj_x, adj_y)  # Check if the square is surrounded by the opposing player
-                        if captured_squares:  # If the square is surrounded by the opposing player
-                            captured_pieces = []
-
-                            controlled_by = 'r' if player_sign == 1 else 'b'  # Determine which symbol to place based on which player will now control the squares
-                            for c_sq in captured_squares:
-                                c_x, c_y = c_sq[0], c_sq[1]
-
-                                if self._board[c_x, c_y] != 0 and self._board[c_x, c_y] not in captured_pieces:
-                                    captured_pieces.append(self._board[c_x, c_y])  # Check if any pieces are captured (Should only be 1 max)
-
-                                self._board[c_x, c_y] = controlled_by  # Update the captured squares to represent control by a player
-                        
-                            return captured_pieces
-        
-        return False  # Returns False if no pieces are captured 
-        
-    def _get_adjacent_squares(self, x, y):
+        h = _PLACED_KEYS[self.total_placed_pieces % len(_PLACED_KEYS)]
+        for sq, piece_id in enumerate(self._piece_ids.tolist()):
+            h ^= _SQUARE_KEYS[piece_id + CATHEDRAL_ID][sq]
+        for player_idx in range(2):
+            for sq in iter_squares(self._territory[player_idx]):
+                h ^= _TERRITORY_KEYS[player_idx][sq]
+        return h
+
+    def _blocked_squares(self, player):
         """
-        Gets all adjacent squares
+        Gets every square the given player cannot place a piece on
 
-        x : x coordinate to be checked around
-        y : y coordinate to be checked around
+        player : the player number (1 or 2)
 
-        return -> all adjacent squares in every direction (including diagonals)
+        return -> mask of all pieces, the cathedral and the opponents territory
         """
 
-        adj_squares = []
+        return self._pieces[0] | self._pieces[1] | self._cathedral | self._territory[2 - player]
 
-        for dx in range(-1 if (x > 0) else 0, 2 if (x < self._board_dimensions-1) else 1):  # Determine which x squares to check based on board dimensions
-            for dy in range( -1 if (y > 0) else 0, 2 if (y < self._board_dimensions-1) else 1):  # Determine which y squares to check based on board dimensions
-                if (dx != 0 or dy != 0):
-                    adj_squares.append((x+dx, y+dy))
+    def _refresh_board_state(self, placed_piece, player_sign):
+        """
+        Used after every player turn to update the board state
+
+        param placed_piece : mask of the most recent placed piece
+        param player_sign : positive/negative numbers associated with each players pieces (1 for p1 or -1 for p2)
+
+        return : any pieces that were captured
+        """
+
+        player_idx = 0 if player_sign == 1 else 1
+        captured_squares, captured_pieces = self._find_captures(placed_piece, player_idx)
+        if not captured_squares:
+            return False  # Returns False if nothing is captured
+
+        # Update the captured squares to represent control by the player who just moved
+        for sq in iter_squares(captured_squares & ~self._territory[player_idx]):
+            self.hash ^= _TERRITORY_KEYS[player_idx][sq]
+        for sq in iter_squares(captured_squares & self._territory[1 - player_idx]):
+            self.hash ^= _TERRITORY_KEYS[1 - player_idx][sq]
+        self._territory[player_idx] |= captured_squares
+        self._territory[1 - player_idx] &= ~captured_squares
+        self._pieces[0] &= ~captured_squares
+        self._pieces[1] &= ~captured_squares
+        self._cathedral &= ~captured_squares
+        for sq in iter_squares(captured_squares):
+            self.hash ^= _SQUARE_KEYS[self._piece_ids.item(sq) + CATHEDRAL_ID][sq]
+            self._piece_ids[sq] = 0
+
+        return captured_pieces
+
+    def _find_captures(self, placed_piece, player_idx):
+        """
+        Finds every region the player who just moved has closed off
+
+        The movers pieces and territory are walls, every other square is free space. The free space around the
+        placed piece is split into regions (see bitboard.enclosed_regions), a region is captured if it holds at most
+        one type of piece (more then 1 type of piece in an area makes the area uncapturable)
+
+        param placed_piece : mask of the most recent placed piece
+        param player_idx : 0 if red just moved, 1 if black just moved
+
+        return : (mask of all captured squares, list of the captured pieces)
+        """
+
+        walls = self._pieces[player_idx] | self._territory[player_idx]
+        occupied = self._pieces[0] | self._pieces[1] | self._cathedral
+        # Only start from empty squares or opponent pieces next to the placed piece, the cathedral and
+        # controlled squares can still be part of a region
+        seeds = dilate(placed_piece) & ~(walls | self._cathedral | self._territory[0] | self._territory[1])
+
+        captured_squares = 0
+        captured_pieces = []
+        for region in enclosed_regions(FULL_MASK & ~walls, seeds):
+            enclosed_piece = 0
+            for sq in iter_squares(region & occupied):
+                piece = self._piece_ids.item(sq)
+                if enclosed_piece == 0:
+                    enclosed_piece = piece
+                elif piece != enclosed_piece:
+                    break  # Two types of piece, the region can't be captured
+            else:
+                captured_squares |= region
+                if enclosed_piece != 0:
+                    captured_pieces.append('c' if enclosed_piece == CATHEDRAL_ID else enclosed_piece)
+
+        return captured_squares, captured_pieces
 
-        return adj_squares
-    
-    def _check_if_surrounded(self, player_sign, x, y):
-        """
-        Checks if a given square is surronded by the opposing player
-
-        player_sign : positive/negative numbers associated with each players pieces (1 for p1 or -1 for p2)
-        x : x coordinate to be checked
-        y : y coordinate to be checked
-
-        return -> either False (not surrounded) or a list of the surrounded squares
-        """
-
-        piece_type_seen = []  # Record each type of piece seen (More then 1 cannot be captured)
-        visited = []  # Record which squares we've visited
-        queue = [(x,y)]  # Intialize the queue
-
-        while queue:
-            
-            x, y = queue.pop(0)
-            if (x, y) in visited:
-                continue  # skip squares that we've already seen
-            visited.append((x, y))
-
-            if len(piece_type_seen) > 1:
-                return False  # Only 1 piece can be surrounded and captured. If there is more then 1 type of piece in an area, the area is uncapturable.
-            
-            for sq in self._get_adjacent_squares(x,y): # Check every adjacent square to the given square
-                nx, ny = sq[0], sq[1]
-                
-                controlled_squares = 'r' if player_sign == 1 else 'b'
-                if (self._board[nx, ny] == controlled_squares): 
-                    queue.append((nx, ny))
-
-                elif (self._board[nx, ny] == 'c'): 
-                    # Special case where the cathedral is seen: This can be captured
-                    queue.append((nx, ny))
-                    if 'c' not in piece_type_seen:
-                        piece_type_seen.append('c')
-                
-                elif (int(self._board[nx, ny]) * player_sign > 0):
-                    # Given square has a player piece on it, so we check around this aswell
-                    queue.append((nx, ny))
-                    if (self._board[nx, ny]) not in piece_type_seen:
-                        piece_type_seen.append(self._board[nx, ny])
-
-                elif (int(self._board[nx, ny]) == 0):
-                    # Given square has nothing on it, so we check this
-                    queue.append((nx, ny))
-
-        return visited
-    
     def _check_if_legal_move(self, target_squares, player):
         """
         Checks if a proposed move is legal
@@ -159,11 +161,7 @@ class Board:
         return -> True if legal, otherwise False
         """
 
-        valid_squares = 'r' if player == 1 else 'b'
-        for target in target_squares:
-            if self._board[target[0], target[1]] != 0 and self._board[target[0], target[1]] != valid_squares:
-                return False
-        return True
+        return not (coords_to_mask(target_squares) & self._blocked_squares(player))
 
     def update(self, target_squares, player, piece_num):
         """
@@ -175,48 +173,127 @@ class Board:
 
         return -> any pieces that have been captured
         """
+        self.hash ^= _PLACED_KEYS[self.total_placed_pieces % len(_PLACED_KEYS)]
         self.total_placed_pieces += 1
+        self.hash ^= _PLACED_KEYS[self.total_placed_pieces % len(_PLACED_KEYS)]
+        self.version += 1
         player_sign = 1 if player == 1 else -1
-        if self._check_if_legal_move(target_squares, player):
-            for target in target_squares:
-                if piece_num == 'c' : 
-                    self._board[target[0], target[1]] = 'c'
-                else:
-                    self._board[target[0], target[1]] = int(piece_num) * player_sign  # Update the target squares with the proper piece number
+        placed = coords_to_mask(target_squares)
+        if not (placed & self._blocked_squares(player)):
+            if piece_num == 'c':
+                self._cathedral |= placed
+                piece_id = CATHEDRAL_ID
+            else:
+                self._pieces[player - 1] |= placed
+                piece_id = int(piece_num) * player_sign  # Update the target squares with the proper piece number
+            for sq in iter_squares(placed & self._territory[player - 1]):
+                self.hash ^= _TERRITORY_KEYS[player - 1][sq]
+            self._territory[player - 1] &= ~placed
+            square_keys = _SQUARE_KEYS[piece_id + CATHEDRAL_ID]
+            for sq in iter_squares(placed):
+                self._piece_ids[sq] = piece_id
+                self.hash ^= square_keys[sq]
             if self.total_placed_pieces <= 3:  # Squares can only be captured after each players first turn
                 return False
-            return self._refresh_board_state(target_squares, player_sign)  # If any pieces are captured, return them to the player
-    
+            return self._refresh_board_state(placed, player_sign)  # If any pieces are captured, return them to the player
+
+    def _to_grid(self):
+        """
+        Builds the readable 10x10 board (see the Board docstring for the values)
+
+        return -> 10x10 object array
+        """
+
+        grid = self._piece_ids.astype(object)
+        grid[grid == CATHEDRAL_ID] = 'c'
+        for sq in iter_squares(self._territory[0]):
+            grid[sq] = 'r'
+        for sq in iter_squares(self._territory[1]):
+            grid[sq] = 'b'
+        return grid.reshape(self._board_dimensions, self._board_dimensions)
+
     def print_board(self):
         """
         Prints the board in a pretty way
         """
 
-        for row in self._board:
+        for row in self._to_grid():
         # Create a formatted string for each row where each element is formatted to be 3 characters wide
             formatted_row = ' '.join(f'{str(item):>3}' for item in row)
             print(formatted_row)
 
+    def legal_placements(self, player, piece_counts, has_cathedral, cathedral_turn=None):
+        """
+        Filters the placement table (see PLACEMENT_MASKS) against the current board
+
+        player : the player number (1 or 2)
+        piece_counts : list of piece counts for that player
+        has_cathedral : boolean, true if player has cathedral, otherwise false
+        cathedral_turn : boolean, true if it is the cathedral turn (only the cathedral can be placed)
+
+        return -> boolean array, True for every placement the player can make
+        """
+
+        available = np.zeros(12, dtype=bool)  # Pieces 1-11 then the cathedral
+        if not cathedral_turn:
+            available[:11] = np.asarray(piece_counts) > 0
+        available[11] = bool(cathedral_turn or has_cathedral)
+
+        blocked_lo, blocked_hi = split_mask(self._blocked_squares(player))
+        fits = ((PLACEMENT_LO & blocked_lo) | (PLACEMENT_HI & blocked_hi)) == 0
+        return fits & available[PLACEMENT_PIECE_INDEX]
+
+    def sample_placement(self, player, piece_counts, has_cathedral, cathedral_turn=None, weights=None, tries=SAMPLE_TRIES):
+        """
+        Draws a random legal placement by rejection: placements of the available pieces are drawn from the
+        placement table until one fits on the board, so the table is never scanned as a whole
+
+        player : the player number (1 or 2)
+        piece_counts : list of piece counts for that player
+        has_cathedral : boolean, true if player has cathedral, otherwise false
+        cathedral_turn : boolean, true if it is the cathedral turn (only the cathedral can be placed)
+        weights : optional weight of each piece (pieces 1-11 then the cathedral), placements are drawn with a probability
+        proportional to the weight of their piece, every legal placement is equally likely by default
+        tries : number of draws before giving up
+
+        return -> the placement id, None if no draw fit (the player may still have a legal placement)
+        """
+
+        # Cumulative weight of the placement block of every available piece (see PIECE_PLACEMENTS)
+        pieces = [11] if cathedral_turn else np.flatnonzero(np.asarray(piece_counts) > 0).tolist() + ([11] if has_cathedral else [])
+        cumulative, total = [], 0.0
+        for piece in pieces:
+            total += (1.0 if weights is None else weights[piece]) * _PIECE_BLOCKS[piece][1]
+            cumulative.append(total)
+        if total <= 0:
+            return None
+
+        blocked = self._blocked_squares(player)
+        for _ in range(tries):
+            # One random number picks the piece and the placement within its block
+            draw = random.random() * total
+            i = min(bisect.bisect_right(cumulative, draw), len(pieces) - 1)
+            piece = pieces[i]
+            start, size = _PIECE_BLOCKS[piece]
+            low = cumulative[i - 1] if i else 0.0
+            placement = start + min(int((draw - low) / (cumulative[i] - low) * size), size - 1)
+            if not PLACEMENT_MASKS[placement] & blocked:
+                return placement
+        return None
+
     def check_if_any_legal_moves(self, player, piece_counts, has_cathedral):
         """
         Finds if there are any legal moves for the given player
 
         player : the player number (1 or 2)
-        piece_counts :
-        has_cathedral :
-        
+        piece_counts : list of piece counts for that player
+        has_cathedral : boolean, true if player has cathedral, otherwise false
+
         return -> True if a legal move is found, otherwise False
         """
 
-        legal_moves = []
-        for piece_number in range(1, 12):
-            if has_cathedral: # If the player has the cathedral, they can re-place it down (this will almost never happen)
-                legal_moves.append(self.find_potential_moves_for_given_piece('c', player))
-            if piece_counts[piece_number-1] > 0:  # Check to see if the player has one of those pieces to place
-                legal_move = self.find_potential_moves_for_given_piece(piece_number, player)
-                if legal_move: return True
-        return False
-    
+        return bool(self.legal_placements(player, piece_counts, has_cathedral).any())
+
     def find_all_legal_moves(self, player, piece_counts, has_cathedral, cathedral_turn=None):
         """
         Creates a list of all legal moves for the given player
@@ -225,27 +302,22 @@ class Board:
         piece_counts : list of piece counts for that player (needs to be atleast 1 to be able to place the piece)
         has_cathedral : boolean, true if player has cathedral, otherwise false
         cathedral_turn : boolean, true if it is the cathedral turn (special turn) otherwise false
-        
+
         return -> a list of all legal moves for each piece for the given player
         """
 
-        legal_moves = []
-        if cathedral_turn:
-            legal_move = self.find_potential_moves_for_given_piece('c', player)
-            for move in legal_move:
-                legal_moves.append(('c', move))
-        else:
-            for piece_number in range(1, 12):
-                if has_cathedral: # If the player has the cathedral, they can re-place it down (this will almost never happen)
-                    legal_move = self.find_potential_moves_for_given_piece('c', player)
-                    for move in legal_move:
-                        legal_moves.append(('c', move))
-                if piece_counts[piece_number-1] > 0:  # Check to see if the player has one of those pieces to place
-                    legal_move = self.find_potential_moves_for_given_piece(piece_number, player)
-                    for move in legal_move:
-                        legal_moves.append((piece_number, move))
-
-        return legal_moves
+        return self.placements_to_moves(self.legal_placements(player, piece_counts, has_cathedral, cathedral_turn))
+
+    def placements_to_moves(self, legal):
+        """
+        Converts a legal placement array (see legal_placements) to a list of moves
+
+        legal : boolean array over the placement table
+
+        return -> list of moves, (piece, squares)
+        """
+
+        return [(PLACEMENT_PIECES[i], PLACEMENT_COORDS[i]) for i in np.flatnonzero(legal)]
 
     def find_potential_moves_for_given_piece(self, piece_number, player):
         """
@@ -253,25 +325,15 @@ class Board:
 
         player : the player number (1 or 2)
         piece_number : the piece number (1-11)
-        
+
         return -> all potential moves for a given piece
         """
 
-        pieces = get_pieces(1) if player == 1 else get_pieces(2)
-        if piece_number == 'c':
-            rotations = get_pieces('c')[2]
-        else:
-            rotations = pieces[int(piece_number)-1][2] # Get all possible rotations of the given piece
-        
-        potential_moves = [] # Intialize the potential moves list
-        
-        for potential_shape in rotations:
-            for move in self.find_potential_moves_for_given_shape(potential_shape, player):
-                # For each shape, get all of the potential moves and add it to the list
-                potential_moves.append(move)
+        start, stop = PIECE_PLACEMENTS[piece_number if piece_number == 'c' else int(piece_number)]
+        blocked_lo, blocked_hi = split_mask(self._blocked_squares(player))
+        fits = ((PLACEMENT_LO[start:stop] & blocked_lo) | (PLACEMENT_HI[start:stop] & blocked_hi)) == 0
+        return [PLACEMENT_COORDS[start + i] for i in np.flatnonzero(fits)]
 
-        return potential_moves
-            
     def find_potential_moves_for_given_shape(self, piece_shape, player):
         """
         Scans the board to final all potential moves for a given piece shape
@@ -282,34 +344,98 @@ class Board:
         return -> a list of all valid placements of that shape
         """
 
-        potential_placements = []  # All potential spots on the board that fit the given shape
-        valid_placements = []  # All valid spots on the board that fit the given shape
-        
-        n, m = piece_shape.shape
-        for i in range(self._board_dimensions - n + 1):
-            for j in range(self._board_dimensions - m + 1):
-                # Find all submatricies of size n x m and add them to potential placements
-                coords = [(x, y) for x in range(i, i + n) for y in range(j, j + m)]
-                potential_placements.append(coords) 
-
-        piece_values = piece_shape.flatten().tolist()  # Flatten the list, we only care about its values now
-
-        valid_player_squares = 'r' if player == 1 else 'b'
-        for shape in potential_placements:
-            coordinates_to_update = []  # Track which coordiantes within the shape need to be updated (0's dont need to be updated)
-            valid = True
-            for n, coords in enumerate(shape):
-                if piece_values[n] != 0 and piece_values[n] != '0': # If a part of the piece needs to be placed
-                    if self._board[coords[0]][coords[1]] != 0 and self._board[coords[0]][coords[1]] != valid_player_squares:
-                        valid = False # If a part of the piece needs to be placed but theres another piece or other player control, its not a valid placement
-                    else:
-                        coordinates_to_update.append((coords[0], coords[1]))  # Its a valid placement at that coordinate, add it to the list of coordinates
-            if valid: valid_placements.append(coordinates_to_update)  # If all of the squares are valid, add it to the list of valid placements
-
-        return valid_placements
-    
+        blocked = self._blocked_squares(player)
+        return [mask_to_coords(placement) for placement in shape_translations(piece_shape) if not (placement & blocked)]
+
     def board_to_array(self):
-        return self._board.flatten().tolist()
+        return self._to_grid().flatten().tolist()
+
+    def save_state(self):
+        """
+        Records everything a move can change on the board
+
+        return -> the saved state, used by restore_state
+        """
+
+        return (tuple(self._pieces), tuple(self._territory), self._cathedral, self._piece_ids.copy(), self.total_placed_pieces, self.hash)
+
+    def restore_state(self, state):
+        """
+        Restores the board to a state recorded by save_state
+
+        state : the saved state
+
+        return -> None
+        """
+
+        pieces, territory, self._cathedral, piece_ids, self.total_placed_pieces, self.hash = state
+        self._pieces = list(pieces)
+        self._territory = list(territory)
+        self._piece_ids[:] = piece_ids
+        self.version += 1
+
+    def to_bytes(self):
+        """
+        Compact serialization of the board: the piece id array, both territory masks and the placed piece count
+        (the piece and cathedral masks are rebuilt from the piece ids)
+
+        return -> bytes, see from_bytes
+        """
+
+        return (self._piece_ids.tobytes() + self._territory[0].to_bytes(_MASK_BYTES, 'little')
+                + self._territory[1].to_bytes(_MASK_BYTES, 'little') + self.total_placed_pieces.to_bytes(2, 'little'))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Rebuilds a board serialized with to_bytes
+
+        data : the serialized board
+
+        return -> the new board
+        """
+
+        board = cls()
+        board._piece_ids[:] = np.frombuffer(data, dtype=np.int8, count=TOTAL_SQUARES)
+        board._pieces = [array_to_mask((board._piece_ids > 0) & (board._piece_ids != CATHEDRAL_ID)),
+                         array_to_mask(board._piece_ids < 0)]
+        board._cathedral = array_to_mask(board._piece_ids == CATHEDRAL_ID)
+        offset = TOTAL_SQUARES
+        board._territory = [int.from_bytes(data[offset:offset + _MASK_BYTES], 'little'),
+                            int.from_bytes(data[offset + _MASK_BYTES:offset + 2 * _MASK_BYTES], 'little')]
+        board.total_placed_pieces = int.from_bytes(data[offset + 2 * _MASK_BYTES:BOARD_BYTES], 'little')
+        board.hash = board._compute_hash()
+        return board
+
+    def clone(self):
+        """
+        Copies the board (only flat masks and the piece id array)
+
+        return -> the new board
+        """
+
+        board = Board.__new__(Board)
+        board._board_dimensions = self._board_dimensions
+        board._total_squares = self._total_squares
+        board._pieces = self._pieces.copy()
+        board._territory = self._territory.copy()
+        board._cathedral = self._cathedral
+        board._piece_ids = self._piece_ids.copy()
+        board.total_placed_pieces = self.total_placed_pieces
+        board.version = self.version
+        board.hash = self.hash
+        return board
+
+    def symmetries(self):
+        """
+        Finds the rotations that leave the board unchanged
+
+        return -> list of rotations (quarter turns clockwise, 1-3), empty for an asymmetric board
+        """
+
+        return [rotation for rotation in range(1, 4)
+                if np.array_equal(self._piece_ids[SQUARE_ROTATIONS[rotation]], self._piece_ids)
+                and all(rotate_mask(mask, rotation) == mask for mask in self._territory)]
 
 
 class Player:
@@ -322,20 +448,35 @@ class Player:
         player_num : 1 for red, 2 for black
         modified_rules : optional arg to specify if tree should be using modified ruleset
         
-        pieces : gets all player pieces
+        piece_counts : how many of each piece (1-11) the player has left
         score : the player score (lower score is better)
         has_cathedral : boolean, if player has cathedral or not
+        hash : Zobrist hash of the piece counts and cathedral ownership (see zobrist.py)
         """
 
         self.player_num = player_num
-        self.pieces = copy.deepcopy(get_pieces(1))if player_num == 1 else copy.deepcopy(get_pieces(2))
-        self.score = 47  # Starting score is sum of all pieces, goal is to place all pieces or get lowest score before game ends
+        self.piece_counts = INITIAL_PIECE_COUNTS.copy()  # Number of each piece (1-11) left to place
+        self.score = STARTING_SCORE  # Starting score is sum of all pieces, goal is to place all pieces or get lowest score before game ends
         if modified_rules and player_num == 2:
             self.has_cathedral = True
         elif not modified_rules and player_num == 1:
             self.has_cathedral = True
         else:
             self.has_cathedral = False
+        self.hash = self._compute_hash()
+
+    def _compute_hash(self):
+        """
+        Computes the Zobrist hash of the player from scratch
+
+        return -> the hash
+        """
+
+        count_keys = _COUNT_KEYS[self.player_num - 1]
+        h = _CATHEDRAL_KEYS[self.player_num - 1] if self.has_cathedral else 0
+        for piece_idx, count in enumerate(self.piece_counts.tolist()):
+            h ^= count_keys[piece_idx][count]
+        return h
     
     def use_piece(self, piece):
         """
@@ -348,34 +489,36 @@ class Player:
 
         # If piece is the cathedral, set cathedral boolean to false
         if piece == 'c':
+            if self.has_cathedral:
+                self.hash ^= _CATHEDRAL_KEYS[self.player_num - 1]
             self.has_cathedral = False
             return True
         
         # If player cannot use piece, return false
-        if self.pieces[int(piece)-1][1] < 1: return False  
+        piece_idx = int(piece)-1
+        count = self.piece_counts.item(piece_idx)
+        if count < 1: return False
 
         # Decrement and update piece count and score
-        self.pieces[int(piece)-1][1] -= 1
-        self.score -= self.pieces[int(piece)-1][0]
+        count_keys = _COUNT_KEYS[self.player_num - 1][piece_idx]
+        self.hash ^= count_keys[count] ^ count_keys[count - 1]
+        self.piece_counts[piece_idx] -= 1
+        self.score -= piece_value(piece)
         
         return True
     
     def get_piece_counts(self):
         """
-        Returns a list of the current players piece count
+        Returns the current players piece counts
 
-        return -> list of the current players piece count
+        return -> array of the current players piece count (shared, do not modify)
         """
 
-        counts = []
-        for piece in self.pieces:
-            counts.append(piece[1])
-        
-        return counts
+        return self.piece_counts
     
     def return_pieces(self, piece):
         """
-        Increments a players piece count if a piece is captured by the other player
+        Increments a players piece count (and score) if a piece is captured by the other player
 
         piece : the piece to be returned
 
@@ -383,10 +526,16 @@ class Player:
         """
 
         if piece == 'c':
+            if not self.has_cathedral:
+                self.hash ^= _CATHEDRAL_KEYS[self.player_num - 1]
             self.has_cathedral = True
         else:
-            piece = abs(piece)
-            self.pieces[int(piece)-1][1] += 1
+            piece = abs(int(piece))
+            count = self.piece_counts.item(piece-1)
+            count_keys = _COUNT_KEYS[self.player_num - 1][piece-1]
+            self.hash ^= count_keys[count] ^ count_keys[count + 1]
+            self.piece_counts[piece-1] += 1
+            self.score += piece_value(piece)
 
     def can_place_cathedral(self):
         """
@@ -396,7 +545,43 @@ class Player:
         """
 
         return self.has_cathedral
-    
+
+    def save_state(self):
+        """
+        Records everything a move can change for the player
+
+        return -> the saved state, used by restore_state
+        """
+
+        return (self.piece_counts.copy(), self.score, self.has_cathedral, self.hash)
+
+    def restore_state(self, state):
+        """
+        Restores the player to a state recorded by save_state
+
+        state : the saved state
+
+        return -> None
+        """
+
+        piece_counts, self.score, self.has_cathedral, self.hash = state
+        self.piece_counts[:] = piece_counts
+
+    def clone(self):
+        """
+        Copies the player
+
+        return -> the new player
+        """
+
+        player = Player.__new__(Player)
+        player.player_num = self.player_num
+        player.piece_counts = self.piece_counts.copy()
+        player.score = self.score
+        player.has_cathedral = self.has_cathedral
+        player.hash = self.hash
+        return player
+
 
 class Piece:
     """
@@ -476,13 +661,11 @@ class Piece:
         return [self._point_value, self._initial_count, self._rotations]
 
 
-def get_pieces(type):
+def _build_catalog():
     """
-    Returns the appropriate piece objects
+    Builds the piece catalog, every entry is read-only so it can be shared by all callers
 
-    type : 1 for red, 2 for black, c for cathedral
-    
-    return -> red pieces/black pieces, or cathedral
+    return -> dict of red pieces (1), black pieces (2) and the cathedral (c)
     """
     # Piece Information
 
@@ -532,15 +715,176 @@ def get_pieces(type):
     piece_values = [(1, 1, 2), (2, 2, 2), (3, 3, 2), (4, 3, 1), (5, 4, 1), (6, 4, 1),
                 (7, 4, 1), (8, 5, 1), (9, 5, 1), (10, 5, 1), (11, 5, 1)] 
 
-    # Return requested piece set
-    if type == 1: 
-        # Red Pieces
-        return [(Piece(piece_values[i][0], piece_values[i][1], piece_values[i][2], shape, 1).get_piece()) for i, shape in enumerate(piece_shapes)]
-    elif type == 2:
-        # Red Pieces
-        return [(Piece(piece_values[i][0], piece_values[i][1], piece_values[i][2], shape, -1).get_piece()) for i, shape in enumerate(piece_shapes)]
-    elif type == 'c':
-        # Cathedral
-        return (Piece('c', 0, 1, cathedral_shape, 1).get_piece())
+    # Build each piece set once
+    red_pieces = tuple(_freeze_piece(Piece(piece_values[i][0], piece_values[i][1], piece_values[i][2], shape, 1)) for i, shape in enumerate(piece_shapes))
+    black_pieces = tuple(_freeze_piece(Piece(piece_values[i][0], piece_values[i][1], piece_values[i][2], shape, -1)) for i, shape in enumerate(piece_shapes))
+    cathedral = _freeze_piece(Piece('c', 0, 1, cathedral_shape, 1))
 
+    return {1: red_pieces, 2: black_pieces, 'c': cathedral}
+
+
+def _freeze_piece(piece):
+    """
+    Converts a piece object to a read-only catalog entry
+
+    piece : the piece object
+
+    return -> (point value, initial count, tuple of all rotations)
+    """
+
+    point_value, initial_count, rotations = piece.get_piece()
+    for shape in rotations:
+        shape.setflags(write=False)
+    return (point_value, initial_count, tuple(rotations))
+
+
+# Piece catalog, built once at import
+PIECE_CATALOG = _build_catalog()
+PIECE_VALUES = tuple(piece[0] for piece in PIECE_CATALOG[1])  # Point value of pieces 1-11
+INITIAL_PIECE_COUNTS = np.array([piece[1] for piece in PIECE_CATALOG[1]], dtype=np.int8)
+INITIAL_PIECE_COUNTS.setflags(write=False)
+STARTING_SCORE = sum(value * count for value, count in zip(PIECE_VALUES, INITIAL_PIECE_COUNTS.tolist()))
+
+# Zobrist keys, built once at import (see zobrist.py)
+_SQUARE_KEYS = random_keys(2 * CATHEDRAL_ID + 1, TOTAL_SQUARES)  # Indexed by piece id + CATHEDRAL_ID, then square
+_SQUARE_KEYS[CATHEDRAL_ID] = [0] * TOTAL_SQUARES  # Empty squares leave the hash unchanged
+_TERRITORY_KEYS = random_keys(2, TOTAL_SQUARES)  # Control of a square by red/black
+_PLACED_KEYS = random_keys(128)  # Number of pieces placed so far (modulo 128)
+_COUNT_KEYS = random_keys(2, len(PIECE_VALUES), int(INITIAL_PIECE_COUNTS.max()) + 1)  # Player, piece, count left
+_CATHEDRAL_KEYS = random_keys(2)  # Player owns the cathedral
+
+
+def get_pieces(type):
+    """
+    Returns the appropriate catalog entries (shared and read-only)
+
+    type : 1 for red, 2 for black, c for cathedral
+
+    return -> red pieces/black pieces, or cathedral
+    """
+
+    return PIECE_CATALOG[type]
+
+
+def piece_value(piece_number):
+    """
+    Returns the point value of a piece
+
+    piece_number : the piece number (1-11) or c for the cathedral
+
+    return -> the point value
+    """
+
+    return 0 if piece_number == 'c' else PIECE_VALUES[int(piece_number)-1]
+
+
+def piece_rotations(piece_number, player=1):
+    """
+    Returns every rotation of a piece
+
+    piece_number : the piece number (1-11) or c for the cathedral
+    player : the player number (1 or 2), sets the sign of the values in each shape
+
+    return -> tuple of read-only shape arrays
+    """
+
+    if piece_number == 'c':
+        return PIECE_CATALOG['c'][2]
+    return PIECE_CATALOG[player][int(piece_number)-1][2]
+
+
+def piece_shape(piece_number, player=1):
+    """
+    Returns the base shape of a piece
+
+    piece_number : the piece number (1-11) or c for the cathedral
+    player : the player number (1 or 2), sets the sign of the values in the shape
+
+    return -> read-only shape array
+    """
+
+    return piece_rotations(piece_number, player)[0]
+
+
+def _build_placement_table():
+    """
+    Builds every placement (piece, rotation and translation) that fits on the empty board.
+    Pieces are stored in order (1-11 then the cathedral), each piece as one contiguous block
+
+    return -> placement pieces, masks, coordinates and the (start, stop) block of each piece
+    """
+
+    pieces, masks, coords, blocks = [], [], [], {}
+    for piece_number in list(range(1, 12)) + ['c']:
+        start = len(masks)
+        for shape in piece_rotations(piece_number):
+            for mask in shape_translations(shape):
+                pieces.append(piece_number)
+                masks.append(mask)
+                coords.append(tuple(mask_to_coords(mask)))
+        blocks[piece_number] = (start, len(masks))
+
+    return tuple(pieces), tuple(masks), tuple(coords), blocks
+
+
+# Placement table, built once at import. Move generation filters it against the board
+PLACEMENT_PIECES, PLACEMENT_MASKS, PLACEMENT_COORDS, PIECE_PLACEMENTS = _build_placement_table()
+PLACEMENT_PIECE_INDEX = np.array([11 if piece == 'c' else piece - 1 for piece in PLACEMENT_PIECES], dtype=np.int8)
+PLACEMENT_LO = np.array([split_mask(mask)[0] for mask in PLACEMENT_MASKS], dtype=np.uint64)
+PLACEMENT_HI = np.array([split_mask(mask)[1] for mask in PLACEMENT_MASKS], dtype=np.uint64)
+PLACEMENT_INDEX = {(piece, mask): i for i, (piece, mask) in enumerate(zip(PLACEMENT_PIECES, PLACEMENT_MASKS))}
+_PIECE_BLOCKS = [(start, stop - start) for start, stop in (PIECE_PLACEMENTS[piece] for piece in list(range(1, 12)) + ['c'])]  # (start, size)
+
+
+def placement_move(placement):
+    """
+    Converts a placement table index back to a move
+
+    placement : index into the placement table
+
+    return -> the move, (piece, squares)
+    """
+
+    return (PLACEMENT_PIECES[placement], PLACEMENT_COORDS[placement])
+
+
+def placement_id(move):
+    """
+    Canonical key of a move: its index in the placement table
+
+    move : the move, (piece, squares)
+
+    return -> the placement index
+    """
+
+    return PLACEMENT_INDEX[(move[0], coords_to_mask(move[1]))]
+
+
+def _build_placement_rotations():
+    """
+    Finds the placement each placement becomes when the board is rotated (every rotation of
+    every piece is in the table, so the rotated placement always exists)
+
+    return -> np.int32 array (4, number of placements), row r for r quarter turns clockwise
+    """
+
+    rotations = np.empty((4, len(PLACEMENT_PIECES)), dtype=np.int32)
+    for rotation in range(4):
+        rotations[rotation] = [PLACEMENT_INDEX[(piece, rotate_mask(mask, rotation))] for piece, mask in zip(PLACEMENT_PIECES, PLACEMENT_MASKS)]
+    return rotations
+
+
+PLACEMENT_ROTATIONS = _build_placement_rotations()
+
+
+def rotate_move(move, rotation):
+    """
+    Rotates a move around the center of the board
+
+    move : the move, (piece, squares)
+    rotation : number of quarter turns clockwise (0-3, negative values turn counterclockwise)
+
+    return -> the rotated move
+    """
 
+    return placement_move(PLACEMENT_ROTATIONS[rotation % 4][placement_id(move)])
@@ -0,0 +1,109 @@
+"""
+Leaf evaluators for the batched search (see MCTS_Node.best_action): an evaluator scores a batch of positions
+in one call, which is how a learned model is run efficiently, and can also return move priors
+
+Protocol: evaluate(games, players) -> (values, priors)
+    games : list of positions (not modified)
+    players : the player to move in each position (1 or 2)
+    values : float array, one value in [-1, 1] per position (1 for a red win, -1 for a black win)
+    priors : None, or a (len(games), NUM_PLACEMENTS) float array of move weights over the placement table
+    (see board.placement_id), the search only reads the entries of legal moves
+"""
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from bitboard import TOTAL_SQUARES, iter_squares
+from board import CATHEDRAL_ID
+from rollout import static_evaluation
+from tree_store import NUM_PLACEMENTS
+
+NUM_PLANES = 6  # Red pieces, black pieces, cathedral, red territory, black territory, player to move
+NUM_FEATURES = NUM_PLANES * TOTAL_SQUARES
+
+
+def encode_positions(games, players):
+    """
+    Stacks positions into the input of a model, one 0/1 plane of the board per feature
+
+    games : list of positions
+    players : the player to move in each position (1 or 2)
+
+    return -> (len(games), NUM_FEATURES) np.float32 array
+    """
+
+    piece_ids = np.stack([game.game_board._piece_ids for game in games])
+    territory = np.zeros((len(games), 2, TOTAL_SQUARES), dtype=bool)
+    for i, game in enumerate(games):
+        for player_idx in range(2):
+            territory[i, player_idx, list(iter_squares(game.game_board._territory[player_idx]))] = True
+
+    planes = np.empty((len(games), NUM_PLANES, TOTAL_SQUARES), dtype=np.float32)
+    planes[:, 0] = (piece_ids > 0) & (piece_ids != CATHEDRAL_ID)
+    planes[:, 1] = piece_ids < 0
+    planes[:, 2] = piece_ids == CATHEDRAL_ID
+    planes[:, 3:5] = territory
+    planes[:, 5] = (np.asarray(players) == 1)[:, None]
+    return planes.reshape(len(games), NUM_FEATURES)
+
+
+class Evaluator(ABC):
+    """
+    Base class of the leaf evaluators, subclasses implement evaluate (see the module docstring)
+    """
+
+    @abstractmethod
+    def evaluate(self, games, players):
+        """
+        Scores a batch of positions
+
+        games : list of positions (not modified)
+        players : the player to move in each position (1 or 2)
+
+        return -> (values, priors), see the module docstring
+        """
+
+
+class StaticEvaluator(Evaluator):
+    """
+    Scores every position with the rollout module's static evaluator, without priors
+    """
+
+    def evaluate(self, games, players):
+        return np.array([static_evaluation(game) for game in games], dtype=np.float64), None
+
+
+class LinearEvaluator(Evaluator):
+    """
+    NumPy reference for a learned model: one linear layer over the encoded positions with a tanh value head and
+    a softmax policy head, the whole batch is scored with two matrix products
+
+    value_weights : (NUM_FEATURES + 1,) weights of the value head, the last entry is the bias
+    policy_weights : (NUM_FEATURES + 1, NUM_PLACEMENTS) weights of the policy head, the last row is the bias
+    """
+
+    def __init__(self, value_weights=None, policy_weights=None, seed=0, scale=0.01):
+        """
+        Sets the weights, missing weights are drawn at random (an untrained model, for testing)
+
+        value_weights : optional value head weights
+        policy_weights : optional policy head weights
+        seed : random seed of the drawn weights
+        scale : standard deviation of the drawn weights
+        """
+
+        rng = np.random.default_rng(seed)
+        if value_weights is None:
+            value_weights = rng.normal(0, scale, NUM_FEATURES + 1)
+        if policy_weights is None:
+            policy_weights = rng.normal(0, scale, (NUM_FEATURES + 1, NUM_PLACEMENTS))
+        self.value_weights = np.asarray(value_weights, dtype=np.float32)
+        self.policy_weights = np.asarray(policy_weights, dtype=np.float32)
+
+    def evaluate(self, games, players):
+        features = encode_positions(games, players)
+        values = np.tanh(features @ self.value_weights[:-1] + self.value_weights[-1])
+        logits = features @ self.policy_weights[:-1] + self.policy_weights[-1]
+        priors = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return values.astype(np.float64), priors / priors.sum(axis=1, keepdims=True)
@@ -2,7 +2,58 @@
 Manages the game state: the board and the two players
 """
 
-from board import Board, Player
+import random
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from board import Board, Player, BOARD_BYTES, PLACEMENT_PIECE_INDEX
+from zobrist import SIDE_KEYS
+
+_PLAYER_FORMAT = struct.Struct('<11sh?')  # Piece counts, score, has cathedral
+
+# Result of Game.turn_state
+# red_has_moves/black_has_moves : booleans, if each player has a legal move
+# moves : the requested players moves (shared list, do not modify), None if no player was given
+# is_over : boolean, is the game over
+# winner : 1 for red, -1 for black, 0 for a tie, None if the game is not over
+TurnState = namedtuple('TurnState', ['red_has_moves', 'black_has_moves', 'moves', 'is_over', 'winner'])
+
+
+def next_player(previous_player, level, modified_rules=None):
+    """
+    Determines which player moves at a given level of the game
+
+    previous_player : the player who made the previous move (1 or 2)
+    level : the level (number of turns played so far)
+    modified_rules : optional arg to specify if the modified ruleset is used
+
+    return -> the player to move (1 or 2)
+    """
+
+    if level == 0:
+        return 1  # Red always starts
+    # Under modified rules, black player places cathedral and their first move together
+    if modified_rules and level == 2:
+        return 2
+    # Under normal rules, red places first cathedral then first piece
+    if not modified_rules and level == 1:
+        return 1
+    return 1 if previous_player == 2 else 2
+
+
+def is_cathedral_turn(level, modified_rules=None):
+    """
+    Determines if the cathedral has to be placed at a given level of the game
+
+    level : the level (number of turns played so far)
+    modified_rules : optional arg to specify if the modified ruleset is used
+
+    return -> boolean
+    """
+
+    return level == (1 if modified_rules else 0)
 
 
 class Game:
@@ -21,38 +72,134 @@ class Game:
         self.red_player = Player(1, modified_rules)
         self.black_player = Player(2, modified_rules)
         self.winner = None
-                
-    def game_over(self):
+        self._version = 0  # Incremented every time a player changes, the turn state is cached for one (board, game) version
+        self._clear_turn_cache(None)
+
+    def _clear_turn_cache(self, cache_key):
         """
-        Determines whether the game is ended or not and returns a winner
+        Clears the cached turn state
 
-        return -> winner if there is a winner, otherwise False
+        cache_key : the (board, game) versions the new cache is built for
+
+        _placements : legal placement arrays for each (player, cathedral turn)
+        _moves : move lists for each (player, cathedral turn)
+        _availability : (red_has_moves, black_has_moves)
+        """
+
+        self._cache_key = cache_key
+        self._placements = {}
+        self._moves = {}
+        self._availability = None
+
+    def _legal_placements(self, player_num, cathedral_turn=None):
+        """
+        Legal placement array of a player, cached with the turn state
+
+        player_num : the player number (1 or 2)
+        cathedral_turn : boolean, is it the turn to place the cathedral
+
+        return -> boolean array over the placement table
+        """
+
+        key = (player_num, bool(cathedral_turn))
+        if key not in self._placements:
+            player = self.red_player if player_num == 1 else self.black_player
+            self._placements[key] = self.game_board.legal_placements(player_num, player.get_piece_counts(), player.can_place_cathedral(), cathedral_turn)
+        return self._placements[key]
+
+    def turn_state(self, player=None, cathedral_turn=None):
+        """
+        Computes in one pass whether each player can move, the move list of the player to move,
+        and whether the game is over (setting the winner). The result is cached until the game changes
+
+        player : the player number to list the moves of (1 or 2), None to skip the move list
+        cathedral_turn : boolean, is it the turn to place the cathedral
+
+        return -> TurnState
         """
 
-        # Check if either player has legal moves
-        red_has_moves = self.game_board.check_if_any_legal_moves(1, self.red_player.get_piece_counts(), self.red_player.can_place_cathedral()) 
-        black_has_moves = self.game_board.check_if_any_legal_moves(2, self.black_player.get_piece_counts(), self.black_player.can_place_cathedral())
+        cache_key = (self.game_board.version, self._version)
+        if self._cache_key != cache_key:
+            self._clear_turn_cache(cache_key)
+
+        # Check if either player has legal moves, the placement arrays are reused for the move list
+        if self._availability is None:
+            self._availability = (bool(self._legal_placements(1).any()), bool(self._legal_placements(2).any()))
+        red_has_moves, black_has_moves = self._availability
+
+        moves = None
+        if player is not None:
+            key = (player, bool(cathedral_turn))
+            if key not in self._moves:
+                self._moves[key] = self.game_board.placements_to_moves(self._legal_placements(player, cathedral_turn))
+            moves = self._moves[key]
 
+        winner = None
         # If both players have no legal moves, game is over
         if not red_has_moves and not black_has_moves:
             if self.red_player.score < self.black_player.score:
-                self.winner = 1
+                winner = 1
             elif self.red_player.score > self.black_player.score:
-                self.winner = -1
-            else:  
-                self.winner = 0
-            
-            return True
-
+                winner = -1
+            else:
+                winner = 0
         # Check if either player has 0 score (played all their pieces)
-        if self.red_player.score == 0:
-            self.winner = 1
-            return True
+        elif self.red_player.score == 0:
+            winner = 1
         elif self.black_player.score == 0:
-            self.winner = -1
-            return True
-        
-        return False
+            winner = -1
+
+        if winner is not None:
+            self.winner = winner
+        return TurnState(red_has_moves, black_has_moves, moves, winner is not None, winner)
+
+    def legal_placement_ids(self, player, cathedral_turn=None):
+        """
+        Legal moves of a player as placement table indices (see board.placement_id), cached with the turn state
+
+        player : the player number (1 or 2)
+        cathedral_turn : boolean, is it the turn to place the cathedral
+
+        return -> np.int32 array of placement ids
+        """
+
+        self.turn_state()  # Make sure the cache belongs to the current position
+        return np.flatnonzero(self._legal_placements(player, cathedral_turn)).astype(np.int32)
+
+    def random_placement(self, player, cathedral_turn=None, weights=None):
+        """
+        Draws a random legal move of a player without listing the moves: rejection sampling over the placement
+        table (see Board.sample_placement), falling back to the legal placement array when the board is too full
+        for the draws to succeed. Every legal move is equally likely, as with random.choice over the move list
+
+        player : the player number (1 or 2)
+        cathedral_turn : boolean, is it the turn to place the cathedral
+        weights : optional weight of each piece (pieces 1-11 then the cathedral), see Board.sample_placement
+
+        return -> the placement id (see board.placement_move), None if the player has no legal move
+        """
+
+        player_state = self.red_player if player == 1 else self.black_player
+        placement = self.game_board.sample_placement(player, player_state.get_piece_counts(), player_state.can_place_cathedral(),
+                                                     cathedral_turn, weights)
+        if placement is not None:
+            return placement
+
+        legal = self.legal_placement_ids(player, cathedral_turn)
+        if len(legal) == 0:
+            return None
+        if weights is None:
+            return int(legal[random.randrange(len(legal))])
+        return random.choices(legal.tolist(), weights=np.asarray(weights)[PLACEMENT_PIECE_INDEX[legal]].tolist())[0]
+
+    def game_over(self):
+        """
+        Determines whether the game is ended or not and returns a winner
+
+        return -> winner if there is a winner, otherwise False
+        """
+
+        return self.turn_state().is_over
 
     def get_potential_moves(self, player, cathedral_turn=None):
         """
@@ -64,7 +211,7 @@ class Game:
         return -> list of all potential moves
         """
 
-        return self.game_board.find_all_legal_moves(player.player_num, player.get_piece_counts(), player.can_place_cathedral(), cathedral_turn=cathedral_turn)
+        return list(self.turn_state(player.player_num, cathedral_turn).moves)
 
     def has_potential_moves(self, player):
         """
@@ -75,8 +222,9 @@ class Game:
         return -> boolean, if any potential moves
         """
 
-        return self.game_board.check_if_any_legal_moves(player.player_num, player.get_piece_counts(), player.can_place_cathedral())
-    
+        state = self.turn_state()
+        return state.red_has_moves if player.player_num == 1 else state.black_has_moves
+
     def use_piece(self, player, piece_selected):
         """
         Use a piece for a player
@@ -87,6 +235,7 @@ class Game:
         return -> None
         """
 
+        self._version += 1
         if player == 1:
             self.red_player.use_piece(piece_selected)
         else: 
@@ -102,10 +251,120 @@ class Game:
         return -> None
         """
 
+        self._version += 1
         if player == 1: 
             self.black_player.return_pieces(returned_piece)
         else: 
             self.red_player.return_pieces(returned_piece)
 
+    def apply_move(self, move, player):
+        """
+        Play a move in place: use the piece, update the board and return any captured piece
+
+        move : the move to play, (piece, squares)
+        player : the player making the move (1 or 2)
+
+        return -> undo record, pass it to undo to restore the game to before the move
+        """
+
+        record = self.snapshot()
+
+        piece_selected = move[0]
+        self.use_piece(player, piece_selected)
+
+        returned_pieces = self.game_board.update(move[1], player, piece_selected)
+        if returned_pieces:  # If any pieces were captured, return them to the opposing player
+            for returned_piece in returned_pieces:
+                self.return_piece(player, returned_piece)
+
+        return record
+
+    def snapshot(self):
+        """
+        Records the whole position, restoring it with undo sets the game to this position
+
+        return -> the record, same format as the undo records of apply_move
+        """
+
+        return (self.game_board.save_state(), self.red_player.save_state(), self.black_player.save_state(), self.winner)
+
+    def undo(self, record):
+        """
+        Take back a move played with apply_move
+
+        record : the undo record returned by apply_move
+
+        return -> None
+        """
+
+        board_state, red_state, black_state, self.winner = record
+        self.game_board.restore_state(board_state)
+        self.red_player.restore_state(red_state)
+        self.black_player.restore_state(black_state)
+        self._version += 1
+
+    def serialize(self):
+        """
+        Compact binary form of the position (board and both players), much smaller and faster then pickling the game
+
+        return -> bytes, see deserialize
+        """
+
+        return (self.game_board.to_bytes()
+                + _PLAYER_FORMAT.pack(self.red_player.piece_counts.tobytes(), self.red_player.score, self.red_player.has_cathedral)
+                + _PLAYER_FORMAT.pack(self.black_player.piece_counts.tobytes(), self.black_player.score, self.black_player.has_cathedral))
+
+    @classmethod
+    def deserialize(cls, data):
+        """
+        Rebuilds a game from serialize
+
+        data : the serialized position
+
+        return -> the new game
+        """
+
+        game = cls()
+        game.game_board = Board.from_bytes(data[:BOARD_BYTES])
+        for i, player in enumerate((game.red_player, game.black_player)):
+            counts, player.score, player.has_cathedral = _PLAYER_FORMAT.unpack_from(data, BOARD_BYTES + i * _PLAYER_FORMAT.size)
+            player.piece_counts[:] = np.frombuffer(counts, dtype=np.int8)
+            player.hash = player._compute_hash()
+        return game
+
+    def position_key(self, turn):
+        """
+        Zobrist hash of the position, the same for every move order that reaches it
+
+        turn : the player who made the last move (1 or 2)
+
+        return -> the hash
+        """
+
+        return self.game_board.hash ^ self.red_player.hash ^ self.black_player.hash ^ SIDE_KEYS[turn]
+
+    def symmetries(self):
+        """
+        Finds the rotations that leave the position unchanged, moves that are rotations of each other
+        by one of them lead to equivalent positions
+
+        return -> list of rotations (quarter turns clockwise, 1-3), empty for an asymmetric position
+        """
+
+        return self.game_board.symmetries()
+
+    def clone(self):
+        """
+        Copy the game (the board masks and the player piece counts), much cheaper then a deepcopy
+
+        return -> the new game
+        """
 
-        
\ No newline at end of file
+        game = Game.__new__(Game)
+        game.game_board = self.game_board.clone()
+        game.red_player = self.red_player.clone()
+        game.black_player = self.black_player.clone()
+        game.winner = self.winner
+        game._version = 0
+        game._clear_turn_cache(None)
+        return game
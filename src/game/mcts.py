@@ -2,178 +2,403 @@
 Handles each game tree node and all tree operations
 """
 
+import math
 import random
-import copy
+import time
+
 import numpy as np
 
+from board import PLACEMENT_ROTATIONS, placement_id, placement_move
+from game import next_player, is_cathedral_turn
+from parallel import get_pool, split_work
+from rollout import random_rollout, rollout_worker, run_rollouts
+from tree_store import TreeStore, NO_NODE
+
+_EVICT_FRACTION = 0.1  # Share of the node budget freed every time the tree reaches it
+
+
 class MCTS_Node:
-    def __init__(self, game, turn, level, parent=None, modified_rules=None):
+    """
+    View over one node of a TreeStore (see tree_store.py), the statistics, links and untried moves
+    of every node live in the store's arrays so a node is only (store, index)
+    """
+
+    __slots__ = ('_store', '_index')
+
+    def __init__(self, game, turn, level, parent=None, modified_rules=None, move=None, stateless=False, symmetric=False):
         """
-        Initializes a node for the Monte Carlo Tree
+        Initializes a node for the Monte Carlo Tree, creating a new tree if no parent is given
+        (the node is not linked to the parent yet, see _add_child)
+
+        stateless : only used for a new tree, if true nodes reached by a known move do not keep their game,
+        the search carries one game down the tree instead and positions are rebuilt on request (see _game)
+        symmetric : only used for a new tree, if true a node whose position is unchanged by some rotations of the board
+        only expands one move of each set of moves that are rotations of each other (see follow)
         
+        _store : the tree store holding the node
+        _index : the node's index in the store
+
+        The store keeps for each node (read through the properties below):
         _game : game class, manages game board
         _red : manages the red player
         _black : manages the black player
         _turn : tracks the current turn, 1 for red, 2 for black
         _level : the level of the tree (0 for root)
         _next_turn : opposite of turn
-        _parent : the parent node, none for root
+        _parent : the parent node (the first one if the position is reached by several moves), none for root
+        _move : the move that led to this node from _parent, none if unknown
         _children : list of all child nodes
         _num_visits : the amount of times this node was visited
-        _untried_moves : the potential moves from the current node
+        _untried_moves : the potential moves from the current node (placement ids in the store)
         _results: track the wins for this node (1 for red, -1 for black, 0 for tie)
         """
 
-        self._game = game # Use this to access game board, players
-        self._red = game.red_player
-        self._black = game.black_player
-        self._turn = turn # 1 for red 2 for black
-        self._level = level
-        self._modified_rules = modified_rules
-
-        # Under modified rules, black player places cathedral and their first move together
-        if self._level == 0:
-            self._next_turn = 1
-        elif self._modified_rules and (self._level == 2):
-            self._next_turn = 2
-        elif not self._modified_rules and (self._level == 1):
-            self._next_turn = 1
-        else:
-            self._next_turn = 1 if self._turn == 2 else 2
+        store = parent._store if parent is not None else TreeStore(modified_rules, stateless, symmetric=symmetric)
+        modified_rules = store.modified_rules
+
+        next_turn = next_player(turn, level, modified_rules)
 
         # If a player does not have a move, skip their turn and go to the other player
-        if not self._game.has_potential_moves(self._red):
-            self._next_turn = 2
-        if not self._game.has_potential_moves(self._black):
-            self._next_turn = 1
-
-        self._parent = parent  # Parent node
-        self._children = []  # List of child nodes
-        self._num_visits = 0  # number of times this node has been visited
-
-        self._results = {}  # Results dictionary
-        self._results[1] = 0  # Red Wins
-        self._results[-1] = 0  # Black Wins
-        self._results[0] = 0  # Ties
-
-        # Special checks to account for cathedral placement
-        if modified_rules and self._level == 1:
-            self._untried_moves = self._game.get_potential_moves(self._black, True)
-        elif not modified_rules and self._level == 0:
-            self._untried_moves = self._game.get_potential_moves(self._red, True)
-        else:
-            if self._next_turn == 2:
-                self._untried_moves = self._game.get_potential_moves(self._black)
-            
-            if self._next_turn == 1:
-                self._untried_moves = self._game.get_potential_moves(self._red)
-                
-        self._untried_moves = self._randomize_potential_moves(self._untried_moves)  # Randomize the potential moves 
+        turn_state = game.turn_state()
+        if not turn_state.red_has_moves:
+            next_turn = 2
+        if not turn_state.black_has_moves:
+            next_turn = 1
+
+        # State-free trees keep only the games that can't be rebuilt from the moves (the root, unknown moves).
+        # The untried moves are listed only once a node is expanded (most nodes are leaves that never are)
+        keep_game = not store.stateless or parent is None or move is None
+
+        self._store = store
+        self._index = store.add_node(game if keep_game else None, turn, next_turn, level, None,
+                                     NO_NODE if parent is None else parent._index,
+                                     NO_NODE if move is None else placement_id(move))
+
+        # Register the position, every move order reaching it will share this node (and its statistics)
+        store.table.setdefault(game.position_key(turn), self._index)
+
+    @classmethod
+    def _view(cls, store, index):
+        """
+        Returns a view over an existing node
+
+        store : the tree store
+        index : the node index
+
+        return -> the node
+        """
+
+        node = cls.__new__(cls)
+        node._store = store
+        node._index = int(index)
+        return node
+
+    def __eq__(self, other):
+        return isinstance(other, MCTS_Node) and self._store is other._store and self._index == other._index
+
+    def __hash__(self):
+        return hash((id(self._store), self._index))
+
+    @property
+    def _game(self):
+        game = self._store.games[self._index]
+        return self._rebuild_game() if game is None else game
+
+    def _rebuild_game(self):
+        """
+        Rebuilds the position of a node without a game (state-free trees), by replaying the moves
+        from the closest ancestor that kept its game
+
+        return -> a new game
+        """
+
+        store = self._store
+        replay = []
+        node = self._index
+        while store.games[node] is None:
+            replay.append(node)
+            node = store.parent[node]
+
+        game = store.games[node].clone()
+        for node in reversed(replay):
+            game.apply_move(placement_move(store.move[node]), int(store.side[node]))
+        return game
+
+    @property
+    def _red(self):
+        return self._game.red_player
+
+    @property
+    def _black(self):
+        return self._game.black_player
+
+    @property
+    def _turn(self):
+        return int(self._store.side[self._index])
+
+    @property
+    def _next_turn(self):
+        return int(self._store.next_side[self._index])
+
+    @property
+    def _level(self):
+        return int(self._store.level[self._index])
+
+    @property
+    def _modified_rules(self):
+        return self._store.modified_rules
+
+    @property
+    def _parent(self):
+        parent = self._store.parent[self._index]
+        return None if parent == NO_NODE else MCTS_Node._view(self._store, parent)
+
+    @property
+    def _move(self):
+        move = self._store.move[self._index]
+        return None if move == NO_NODE else placement_move(move)
+
+    @property
+    def _children(self):
+        return [MCTS_Node._view(self._store, child) for child in self._store.children(self._index)]
+
+    @property
+    def _num_visits(self):
+        return int(self._store.visits[self._index])
+
+    @property
+    def _results(self):
+        return self._store.results(self._index)
+
+    @property
+    def _untried_moves(self):
+        return [placement_move(placement) for placement in self._untried()]
+
+    @property
+    def _table(self):
+        return self._store.table
         
-    def _expand(self):
+    def _find_untried_moves(self, game):
+        """
+        Lists the potential moves from the current node (in placement order, they are drawn at random by _draw_untried)
+
+        game : the game at the node's position
+
+        return -> np.int16 array of placement ids
+        """
+
+        # Special checks to account for cathedral placement (the availability found at creation is reused, no new scan)
+        cathedral_turn = is_cathedral_turn(self._level, self._modified_rules)
+        placements = game.legal_placement_ids(self._next_turn, cathedral_turn)
+        if self._store.symmetric:
+            # On a symmetric position keep the smallest placement id of every set of equivalent moves
+            symmetries = game.symmetries()
+            if symmetries:
+                placements = placements[placements == PLACEMENT_ROTATIONS[[0] + symmetries][:, placements].min(axis=0)]
+        return placements.astype(np.int16)
+
+    def _untried(self, game=None):
+        """
+        Untried placement ids of the current node, listed on first use
+
+        game : the position of this node if it is carried by the search, none to use the node's game
+
+        return -> np.int16 array of placement ids, expanded from the end
+        """
+
+        untried = self._store.untried[self._index]
+        if untried is None:
+            untried = self._store.untried[self._index] = self._find_untried_moves(game or self._game)
+        return untried
+
+    def _expand(self, game=None, history=None):
         """
         Expand the tree from the current node
 
+        game : the game carried down the tree (state-free trees), none to use the node's game
+        history : undo records of the moves played on the carried game
+
         return -> a new child node with the updated board/player state after playing an untried move
         """
 
-        move = self._untried_moves.pop()  # Pop an untried move
-        
-        updated_game = copy.deepcopy(self._game)  # Make a deepcopy of the current game, this is the game for the new node
+        self._draw_untried(game)
+        untried = self._store.untried[self._index]
+        self._store.untried[self._index] = untried[:-1]  # Pop the drawn move
+        return self._add_child(int(untried[-1]), game, history)
 
-        piece_selected = move[0] 
-        updated_game.use_piece(self._next_turn, piece_selected)
-        
-        returned_pieces = updated_game.game_board.update(move[1], self._next_turn, move[0])  # Update the new game, this is the initial game for the new node
-        if returned_pieces: 
-            updated_game.return_piece(self._next_turn, returned_pieces[0])
+    def _draw_untried(self, game=None):
+        """
+        Swaps a random untried move to the end of the untried moves, where _expand pops it (one move is drawn
+        per expansion, the list is never shuffled as a whole). Moves already expanded by advance are dropped
+        as they are drawn, so advance never has to search the untried moves. The untried moves of a node
+        scored with priors are sorted (see _order_untried), the last one is taken as is
 
-        # Create a new child node with the updated board/player states
-        child_node = MCTS_Node(updated_game, self._next_turn, self._level+1, parent=self, modified_rules=self._modified_rules)
-        self._children.append(child_node)
-        
+        game : the position of this node if it is carried by the search, none to use the node's game
+
+        return -> None
+        """
+
+        store = self._store
+        untried = self._untried(game)
+        ordered = self._index in store.ordered
+        while len(untried):
+            if not ordered:
+                i = random.randrange(len(untried))
+                untried[i], untried[-1] = untried[-1], untried[i]
+            if store.child(self._index, untried[-1]) == NO_NODE:
+                break
+            untried = untried[:-1]
+        store.untried[self._index] = untried
+
+    def _add_child(self, placement, game=None, history=None):
+        """
+        Create the child node reached by playing a move from the current node, if the position is
+        already in the tree (a transposition) the existing node becomes the child
+
+        placement : placement id of the move to play (see board.placement_id)
+        game : the game carried down the tree (state-free trees), the move stays played on it
+        history : undo records of the moves played on the carried game
+
+        return -> the child node
+        """
+
+        store = self._store
+        carried = game is not None
+        if not carried:
+            game = self._game
+        next_turn = self._next_turn
+        move = placement_move(placement)
+
+        record = game.apply_move(move, next_turn)  # Play the move in place to look up the new position
+        child = store.table.get(game.position_key(next_turn), NO_NODE)
+        if child == NO_NODE:
+            # Create a new child node with the updated board/player states (a state-free node does not keep the game)
+            child_game = game if carried else game.clone()
+            child_node = MCTS_Node(child_game, next_turn, self._level+1, parent=self, move=move)
+        else:
+            child_node = MCTS_Node._view(store, child)
+
+        if carried:
+            history.append(record)
+        else:
+            game.undo(record)
+
+        store.add_edge(self._index, child_node._index, placement)
         return child_node
     
-    def _rollout(self):
+    def _rollout(self, game=None, rollout_depth=None):
         """
-        Simulate the rest of the game from the current position
+        Simulate the rest of the game from the current position (in place, see rollout.py)
+
+        game : the position of this node if it is carried by the search, none to use the node's game
+        rollout_depth : optional number of plies after which the game is scored by the static evaluator
 
-        return -> the simulated game's winner
+        return -> the simulated game's winner, or its estimated value in [-1, 1]
         """
 
-        simulated_game = copy.deepcopy(self._game)  # Make a deepycopy of the current game state to simulate from
-        current_turn = self._turn
-        current_level = self._level
-        
-        while not simulated_game.game_over(): 
-            # While the game is not over
-
-            if self._modified_rules and (current_level == 2):
-                current_turn = 2
-            # Under normal rules, red places first cathedral then first piece
-            elif not self._modified_rules and (current_level == 1):
-                current_turn = 1
-            else:
-                current_turn = 1 if current_turn == 2 else 2
+        return random_rollout(game or self._game, self._turn, self._level, self._modified_rules, max_plies=rollout_depth)
 
-            current_player = simulated_game.red_player if current_turn == 1 else simulated_game.black_player
+    def _batch_rollout(self, num_rollouts, game=None, rollout_depth=None):
+        """
+        Simulate several games from the current position, each from its own seed (see rollout.run_rollouts)
 
-            # Get potential moves for the current player
-            cathedral_turn = True if (self._modified_rules and current_level == 1) else None
-            potential_moves = simulated_game.get_potential_moves(current_player, cathedral_turn)
+        num_rollouts : the number of games to simulate
+        game : the position of this node if it is carried by the search, none to use the node's game
+        rollout_depth : optional number of plies after which the games are scored by the static evaluator
 
-            # If the current player can make a move, if not flip to the other player/end the game
-            if potential_moves: 
-                move_selected = self._rollout_policy(potential_moves)  # Select a move based on rollout policy (right now just pick a random move)
+        return -> list of the simulated games winners (or values)
+        """
 
-                # Remove the piece from the players piece count
-                piece_selected = move_selected[0] 
-                simulated_game.use_piece(current_turn, piece_selected)
+        seeds = [random.getrandbits(32) for _ in range(num_rollouts)]
+        return run_rollouts(game or self._game, self._turn, self._level, seeds, self._modified_rules, rollout_depth)
 
-                # Update the board
-                returned_pieces = simulated_game.game_board.update(move_selected[1], current_turn, move_selected[0])
-                if returned_pieces:  # If any pieces were captured, return them to the opposing player
-                    simulated_game.return_piece(current_turn, returned_pieces[0])
-        
-            # Go to the next 'level' (next order of potential moves)
-            current_level+=1
+    def _parallel_rollout(self, num_rollouts, workers, game=None, rollout_depth=None):
+        """
+        Simulate several games from the current position on a process pool, the position is sent
+        to the workers in its compact serialized form
 
-        return simulated_game.winner  # Once a winner is found, end simulation
+        num_rollouts : the number of games to simulate
+        workers : number of worker processes
+        game : the position of this node if it is carried by the search, none to use the node's game
+        rollout_depth : optional number of plies after which the games are scored by the static evaluator
 
-    def _rollout_policy(self, potential_moves):
+        return -> list of the simulated games winners (or values)
         """
-        The policy for selecting which moves to simulate 
-        for now it is just picking a random move
 
-        potential_moves : list of potential moves to pick from
+        position = (game or self._game).serialize()
+        seeds = [random.getrandbits(32) for _ in range(num_rollouts)]
+        pool = get_pool(workers)
+        futures, start = [], 0
+        for count in split_work(num_rollouts, workers):
+            if count > 0:
+                futures.append(pool.submit(rollout_worker, position, self._turn, self._level, self._modified_rules, seeds[start:start+count],
+                                           rollout_depth))
+            start += count
 
-        return -> a random choice of potential moves
+        return [reward for future in futures for reward in future.result()]
+
+    def _order_untried(self, priors, game=None):
+        """
+        Sorts the untried moves by an evaluator's priors, the most likely move is expanded first
+
+        priors : weight of every placement id (see evaluator.py)
+        game : the position of this node if it is carried by the search, none to use the node's game
+
+        return -> None
         """
 
-        return random.choice(potential_moves)
+        untried = self._untried(game)
+        self._store.untried[self._index] = untried[np.argsort(priors[untried], kind='stable')]
+        self._store.ordered.add(self._index)
 
-    def _backpropagate(self, result):
+    def _backpropagate_results(self, rewards, path=None):
         """
-        Backpropgate the result up the tree
+        Backpropagate several results up the tree in one pass
 
-        result : the result of the simulated node (1 for red win, -1 for black win, 0 for tie)
+        rewards : list of results (1 for red win, -1 for black win, 0 for tie), a value in between from a truncated
+        rollout counts as that share of a win and the rest as a tie
+        path : the nodes visited by the selection, from the search root to this node (a node reached through a
+        transposition can have several parents, the path says which ones to update), none to follow the parents
 
         return -> None
         """
 
-        self._num_visits += 1
-        self._results[result] += 1
-        if self._parent:
-            self._parent._backpropagate(result)  # Backprop
+        counts = {1: sum(max(reward, 0) for reward in rewards), -1: sum(max(-reward, 0) for reward in rewards)}
+        counts[0] = len(rewards) - counts[1] - counts[-1]
+        if path:
+            nodes = [node._index for node in path]
+            parent = self._store.parent[nodes[0]]
+            if parent != NO_NODE:
+                nodes.extend(self._store.ancestors(parent))
+        else:
+            nodes = self._store.ancestors(self._index)
+        self._store.add_results(nodes, counts, len(rewards))
 
-    def _is_fully_expanded(self):
+    def _is_fully_expanded(self, game=None):
         """
         Determines if the tree is fully expanded (no potential moves from current node)
 
+        game : the position of this node if it is carried by the search, none to use the node's game
+
         return -> True if untried moves, false otherwise
         """
 
-        return len(self._untried_moves) == 0
+        self._draw_untried(game)
+        return len(self._store.untried[self._index]) == 0
+
+    def _can_widen(self, widening):
+        """
+        Progressive widening: a node visited n times may only have k * n^alpha children
+
+        widening : (k, alpha), None to allow every move
+
+        return -> True if a new child may be added
+        """
+
+        if widening is None:
+            return True
+        k, alpha = widening
+        return self._store.num_children[self._index] < max(1, k * self._get_num_visits() ** alpha)
 
     def _best_child(self, C):
         """
@@ -185,11 +410,39 @@ class MCTS_Node:
         return -> returns the child with the highest weight (most promising)
         """
 
-        choices_weights = [(child._get_num_wins() / child._get_num_visits()) + C * \
-                           np.sqrt((2 * np.log(self._get_num_visits()) / child._get_num_visits())) for child in self._children]
-        return self._children[np.argmax(choices_weights)]  # Return the strongest node
+        return MCTS_Node._view(self._store, self._store.edge_child[self._best_edge(C)])
+
+    def _most_visited_child(self):
+        """
+        The child with the most visits (the move choice of an interrupted search, see best_action)
+
+        return -> the child node, ties go to the child added first, None if the node has no children (the game is over)
+        """
+
+        store = self._store
+        edges = store.edges(self._index)
+        if len(edges) == 0:
+            return None
+        return MCTS_Node._view(store, store.edge_child[edges[np.argmax(store.visits[store.edge_child[edges]])]])
+
+    def _best_edge(self, C):
+        """
+        UCB selection over the edges of the current node (see _best_child), the child statistics are gathered
+        from the store's arrays through the node's contiguous edge array and scored in one expression
+
+        C : the exploration paramter
 
-    def _tree_policy(self, C):
+        return -> the edge leading to the most promising child, ties (including several unvisited children)
+        go to the child added first
+        """
+
+        store = self._store
+        edges = store.edges(self._index)
+        children = store.edge_child[edges]
+        choices_weights = ucb1(store.wins[children] - store.losses[children], store.visits[children], self._get_num_visits(), C)
+        return edges[np.argmax(choices_weights)]  # Return the strongest node, argmax keeps the first of equal weights
+
+    def _tree_policy(self, C, path=None, game=None, history=None, widening=None):
         """
         Determines the policy for expanding the tree
         If the current node is not an end node, and the tree is not fully expanded
@@ -197,30 +450,52 @@ class MCTS_Node:
         return the best child node
 
         C : the exploration paramter
+        path : optional list, every node visited after the current node is appended to it
+        game : optional game at the current node's position carried down the tree (state-free trees), every move
+        on the way down is played on it and its undo record appended to history
+        history : list for the undo records of the carried game
+        widening : optional (k, alpha), progressive widening (see _can_widen)
 
         return -> the expanded node, the best node, or the current node if game is over
         """
 
+        store = self._store
         current_node = self
-        while not current_node._is_terminal_node():
+        while not current_node._is_terminal_node(game):
             # If the game isnt over
     
-            if not current_node._is_fully_expanded():
+            if current_node._can_widen(widening) and not current_node._is_fully_expanded(game):
                 # Expand the tree to a new node if theres still potential moves to explore
-                return current_node._expand()
+                current_node = current_node._expand(game, history)
+                if path is not None:
+                    path.append(current_node)
+                return current_node
             else:
                 # If not, just return the best child
-                current_node = current_node._best_child(C)
+                edge = current_node._best_edge(C)
+                if game is not None:
+                    move = store.edge_move[edge]
+                    if move == NO_NODE:
+                        # The move is unknown but the child kept its game, jump to its position (undone like a move)
+                        history.append(game.snapshot())
+                        game.undo(store.games[store.edge_child[edge]].snapshot())
+                    else:
+                        history.append(game.apply_move(placement_move(move), current_node._next_turn))
+                current_node = MCTS_Node._view(store, store.edge_child[edge])
+                if path is not None:
+                    path.append(current_node)
         
         return current_node
 
-    def _is_terminal_node(self):
+    def _is_terminal_node(self, game=None):
         """
         Check if the game is over
 
+        game : the position of this node if it is carried by the search, none to use the node's game
+
         return -> boolean, is game over
         """
-        return self._game.game_over()
+        return (game or self._game).game_over()
 
     def _get_num_wins(self):
         """
@@ -230,12 +505,8 @@ class MCTS_Node:
         return -> win/loss ratio depending on the player turn at this node
         """
 
-        red_wins = self._results[1]
-        black_wins = self._results[-1]
-        if self._turn == 1: 
-            return red_wins-black_wins 
-        elif self._turn == 2:
-            return black_wins-red_wins
+        # The store keeps wins/losses from the point of view of the player at this node
+        return self._store.wins.item(self._index) - self._store.losses.item(self._index)
     
     def _get_num_visits(self):
         """
@@ -246,19 +517,6 @@ class MCTS_Node:
 
         return self._num_visits
 
-    def _randomize_potential_moves(self, potential_moves):
-        """
-        Helper function to randomize the list of potential moves
-        this is useful when there are too many potential moves,
-        but you want a more representaive sample of the possible
-        moves rather then just the potential moves of a few pieces
-
-        return -> the shuffled list
-        """
-
-        random.shuffle(potential_moves)
-        return potential_moves
-    
     def _check_equivelence(self, game_state):
         """
         Check if the current nodes game state and the given game state are the same
@@ -273,22 +531,337 @@ class MCTS_Node:
         else:
             return False
     
-    def best_action(self, num_games, C):
+    def best_action(self, num_games, C, rollouts_per_leaf=1, workers=1, rollout_workers=1, max_nodes=None, time_limit=None,
+                    early_stop=False, widening=None, rollout_depth=None, evaluator=None, eval_batch=8):
+        """
+        Find the best action from the current node, the search stops at whichever of num_games and time_limit comes first
+
+        num games : number of nodes to expand (per turn), None to search until the time limit
+        C : exploration parameter
+        rollouts_per_leaf : number of games to simulate from each new node
+        workers : number of processes, more then 1 grows an independent tree per worker and merges them (root parallel)
+        rollout_workers : number of processes, more then 1 splits the rollouts of each new node over them (leaf parallel)
+        max_nodes : optional node budget, the least visited leaves are evicted when the tree reaches it (see TreeStore.evict
+        and _enforce_budget), the tree stays within the budget up to the nodes added by one iteration, the workers of a
+        root parallel search keep their own trees within the budget and only add the children of the current node
+        time_limit : optional number of seconds to search for
+        early_stop : stop once the most visited child can't be overtaken in the remaining iterations (every worker of a
+        root parallel search decides on its own tree)
+        widening : optional (k, alpha), a node visited n times only gets k * n^alpha children (progressive widening)
+        rollout_depth : optional number of plies after which a rollout stops and the position is scored by the static
+        evaluator (see rollout.static_evaluation), None to play every rollout to the end
+        evaluator : optional leaf evaluator (see evaluator.py) used instead of rollouts, the leaves are
+        selected and scored in batches (see _batched_search), single process only
+        eval_batch : number of leaves scored per evaluator call
+
+        return -> the best performing child node of the current node, the most visited child when the search
+        can be cut short (time_limit or early_stop), which is the child the early stop rule is decided on
+        (None if the game is over). The search always runs at least one iteration, even past the time limit
+        """
+
+        if num_games is None and time_limit is None:
+            raise ValueError("best_action needs a number of games or a time limit")
+
+        if evaluator is not None:
+            if workers > 1 or rollout_workers > 1:
+                raise ValueError("the evaluator search runs in a single process")
+            self._batched_search(num_games, C, evaluator, eval_batch, max_nodes, time_limit, widening)
+        elif workers > 1:
+            self._root_parallel_search(num_games, C, rollouts_per_leaf, workers, max_nodes, time_limit, early_stop, widening,
+                                       rollout_depth)
+        else:
+            self._search(num_games, C, rollouts_per_leaf, rollout_workers, max_nodes, time_limit, early_stop, widening, rollout_depth)
+
+        if early_stop or time_limit is not None:
+            return self._most_visited_child()
+        return self._best_child(C)
+
+    def _search(self, num_games, C, rollouts_per_leaf=1, rollout_workers=1, max_nodes=None, time_limit=None, early_stop=False,
+                widening=None, rollout_depth=None):
         """
-        Find the best action from the current node
+        Run the MCTS iterations (select/expand, simulate, backpropagate) from the current node
 
-        num games : number of nodes to expand (per turn)
+        num games : number of nodes to expand, None for no limit
         C : exploration parameter
+        rollouts_per_leaf : number of games to simulate from each new node
+        rollout_workers : number of processes to split the rollouts of each new node over
+        max_nodes : optional node budget of the tree
+        time_limit : optional number of seconds to search for
+        early_stop : stop once the most visited child can't be overtaken in the remaining iterations
+        widening : optional (k, alpha) for progressive widening
+        rollout_depth : optional number of plies after which rollouts are scored by the static evaluator
+
+        return -> number of iterations run
+        """
+
+        store = self._store
+        started = time.monotonic()
+        deadline = None if time_limit is None else started + time_limit
+
+        # State-free trees carry one game down the tree, every iteration undoes its moves afterwards
+        game = self._game.clone() if store.stateless else None
+        history = []
+
+        iterations = 0
+        while num_games is None or iterations < num_games:
+            if iterations and (deadline is not None or early_stop):  # The first iteration always runs
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                if early_stop:
+                    # Iterations left in the budget, the time left is converted at the rate so far
+                    remaining = math.inf if num_games is None else num_games - iterations
+                    if deadline is not None:
+                        remaining = min(remaining, (deadline - now) * iterations / max(now - started, 1e-9))
+                    if self._is_decided(remaining * rollouts_per_leaf):
+                        break
+
+            path = [self]
+            node = self._tree_policy(C, path, game, history, widening)  # Either a new node or the best child
+            if rollout_workers > 1:
+                rewards = node._parallel_rollout(rollouts_per_leaf, rollout_workers, game, rollout_depth)
+            elif rollouts_per_leaf > 1:
+                rewards = node._batch_rollout(rollouts_per_leaf, game, rollout_depth)
+            else:
+                rewards = [node._rollout(game, rollout_depth)]  # Simulate a game from this node
+            node._backpropagate_results(rewards, path)  # Backprop results of sim along the selected path
+
+            while history:
+                game.undo(history.pop())
 
-        return -> the best performing child node of the current node
+            self._enforce_budget(max_nodes)
+            iterations += 1
+
+        return iterations
+
+    def _batched_search(self, num_games, C, evaluator, batch_size, max_nodes=None, time_limit=None, widening=None):
         """
+        Run the MCTS iterations with a leaf evaluator: up to batch_size leaves are selected, each path holding a
+        virtual loss so the next selections spread over other moves, then the leaves are scored in one evaluator
+        call and the values backpropagated (the virtual losses are taken back)
+
+        num games : number of leaves to evaluate, None for no limit
+        C : exploration parameter
+        evaluator : the leaf evaluator (see evaluator.py)
+        batch_size : most leaves per evaluator call
+        max_nodes : optional node budget of the tree
+        time_limit : optional number of seconds to search for
+        widening : optional (k, alpha) for progressive widening
+
+        return -> number of leaves evaluated
+        """
+
+        store = self._store
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        game = self._game.clone() if store.stateless else None
+        history = []
+
+        if self._index not in store.ordered and not self._is_terminal_node(game):
+            # The search root is never a leaf, its priors are asked for once
+            _, priors = evaluator.evaluate([game or self._game], [self._next_turn])
+            if priors is not None:
+                self._order_untried(priors[0], game)
+
+        iterations = 0
+        while (num_games is None or iterations < num_games) and (deadline is None or not iterations or time.monotonic() < deadline):
+            count = batch_size if num_games is None else min(batch_size, num_games - iterations)
+            leaves, results = [], []  # (node, path, position) of the leaves to score, (node, path, winner) of finished games
+            for _ in range(count):
+                path = [self]
+                node = self._tree_policy(C, path, game, history, widening)
+                position = game or node._game
+                if position.game_over():
+                    results.append((node, path, position.winner))
+                else:
+                    leaves.append((node, path, position.clone() if game is not None else position))  # The carried game is rewound below
+                    store.visits[[step._index for step in path]] += 1  # Virtual loss
+                    store.losses[[step._index for step in path]] += 1
+                while history:
+                    game.undo(history.pop())
+
+            if leaves:
+                values, priors = evaluator.evaluate([position for _, _, position in leaves],
+                                                    [node._next_turn for node, _, _ in leaves])
+                for i, (node, path, position) in enumerate(leaves):
+                    store.visits[[step._index for step in path]] -= 1
+                    store.losses[[step._index for step in path]] -= 1
+                    if priors is not None:
+                        node._order_untried(priors[i], position)
+                    results.append((node, path, float(values[i])))
+
+            for node, path, value in results:
+                node._backpropagate_results([value], path)
+
+            self._enforce_budget(max_nodes)
+            iterations += count
+
+        return iterations
+
+    def _enforce_budget(self, max_nodes):
+        """
+        Evicts leaves once the tree reaches its node budget, a batch of leaves is freed at once so the eviction runs
+        once every many iterations. The children of the current node are kept for the move choice as long as
+        the budget allows, a node with more moves than the budget also loses its least visited children (their
+        results stay in the node, their moves are expanded again if the search returns to them)
+
+        max_nodes : the node budget, None for no limit
 
-        for i in range(num_games):
-            node = self._tree_policy(C)  # Either a new node or the best child
-            reward = node._rollout()  # Simulate a game from this node
-            node._backpropagate(reward)  # Backprop results of sim
+        return -> None
+        """
 
-        return self._best_child(C)   
+        store = self._store
+        if max_nodes is None or store.size() < max_nodes:
+            return
+        target = int(max_nodes * (1 - _EVICT_FRACTION))
+        children = store.children(self._index)
+        store.evict(store.size() - target, [self._index] + children.tolist())
+        if store.size() > target and len(children):
+            best = children[np.argmax(store.visits[children])]  # Always keep a move to play
+            store.evict(store.size() - target, [self._index, best])
+
+    def _is_decided(self, remaining_visits):
+        """
+        Checks if the most visited child is certain to stay the most visited one
+
+        remaining_visits : the most visits the search can still add below the current node
+
+        return -> boolean
+        """
+
+        visits = self._store.visits[self._store.children(self._index)]
+        if len(visits) == 0:
+            return False
+        top = np.sort(visits)[-2:]
+        runner_up = top[0] if len(top) == 2 else 0  # An untried move would start from 0
+        return top[-1] - runner_up > remaining_visits
+
+    def _root_parallel_search(self, num_games, C, rollouts_per_leaf, workers, max_nodes=None, time_limit=None, early_stop=False,
+                              widening=None, rollout_depth=None):
+        """
+        Split the iterations over a process pool, every worker grows its own tree from the current
+        position with its own random seed, then the child statistics are merged into this node (its totals also
+        go to every ancestor, like the backpropagation of a single process search)
+
+        num games : number of nodes to expand (in total), None for no limit
+        C : exploration parameter
+        rollouts_per_leaf : number of games to simulate from each new node
+        workers : number of worker processes
+        max_nodes : optional node budget of every worker's tree
+        time_limit : optional number of seconds every worker searches for
+        early_stop : every worker stops once the most visited child of its tree can't be overtaken
+        widening : optional (k, alpha) for progressive widening
+        rollout_depth : optional number of plies after which rollouts are scored by the static evaluator
+
+        return -> None
+        """
+
+        pool = get_pool(workers)
+        shares = [None] * workers if num_games is None else [games for games in split_work(num_games, workers) if games > 0]
+        futures = [pool.submit(_grow_root_tree, self._game.clone(), self._turn, self._level, self._modified_rules,
+                               worker_games, C, rollouts_per_leaf, random.getrandbits(32), self._store.stateless, max_nodes,
+                               time_limit, early_stop, widening, self._store.symmetric, rollout_depth)
+                   for worker_games in shares]
+
+        for future in futures:
+            num_visits, results, child_stats = future.result()
+            self._store.add_results(self._store.ancestors(self._index), results, num_visits)
+            for move, child_visits, child_results in child_stats:
+                self.advance(move)._merge_stats(child_visits, child_results)
+
+    def _merge_stats(self, num_visits, results):
+        """
+        Add visits and results gathered elsewhere (for example by another process) to this node
+
+        num_visits : number of visits to add
+        results : results dictionary to add
+
+        return -> None
+        """
+
+        self._store.add_results([self._index], results, num_visits)
+
+    def advance(self, move):
+        """
+        Find the child reached by a move, expanding it if it is not in the tree yet
+        (used to follow the moves actually played, no board comparison or game copy is needed)
+
+        move : the move, (piece, squares)
+
+        return -> the child node
+        """
+
+        placement = placement_id(move)
+        child = self._store.child(self._index, placement)
+        if child == NO_NODE:
+            return self._add_child(placement)  # The move stays in the untried moves, it is skipped once reached
+        return MCTS_Node._view(self._store, child)
+
+    def tree_stats(self):
+        """
+        Size of the tree the node belongs to
+
+        return -> dictionary: nodes, edges, evicted (number of nodes evicted by the node budget so far)
+        """
+
+        return self._store.stats()
+
+    def follow(self, move, rotation=0):
+        """
+        Follows a move played in a game whose position is this node's position turned back by rotation.
+        A symmetric tree only has one of the moves that are rotations of each other, the move is turned
+        into that one and the game is from then on followed with a different rotation
+
+        move : the move played in the game, (piece, squares)
+        rotation : number of quarter turns clockwise from the game to the tree (see board.rotate_move)
+
+        return -> (child node, rotation from the game to the child)
+        """
+
+        placement = PLACEMENT_ROTATIONS[rotation][placement_id(move)]
+        if self._store.symmetric:
+            symmetries = [0] + self._game.symmetries()
+            images = PLACEMENT_ROTATIONS[symmetries, placement]
+            best = int(np.argmin(images))
+            placement = images[best]
+            rotation = (rotation + symmetries[best]) % 4
+        return self.advance(placement_move(placement)), rotation
+
+    def move_to(self, child):
+        """
+        Find the move leading to a child of this node
+
+        child : the child node
+
+        return -> the move, (piece, squares), None if the child was not reached by a known move
+        """
+
+        store = self._store
+        for edge in store.edges(self._index):
+            if store.edge_child[edge] == child._index and store.edge_move[edge] != NO_NODE:
+                return placement_move(store.edge_move[edge])
+        return None
+    
+    def prune(self, depth=None, opening=None, opening_depth=0):
+        """
+        Moves the part of the tree that is still needed to a new store and frees the rest: the subtree of this node,
+        optionally with the first levels below another node (an opening kept across games). The statistics of kept
+        nodes are unchanged, every other view of the old tree is invalid afterwards
+
+        depth : number of levels below this node to keep, None for the whole subtree
+        opening : optional node whose first levels are kept too (usually the root of the tree)
+        opening_depth : number of levels below opening to keep
+
+        return -> (this node, the opening node or None) in the new store
+        """
+
+        old = self._store
+        keep = [(self._index, depth)]
+        if opening is not None:
+            keep.append((opening._index, opening_depth))
+        store, index = old.prune(keep, lambda node: MCTS_Node._view(old, node)._rebuild_game())
+
+        node = MCTS_Node._view(store, index[self._index])
+        return node, None if opening is None else MCTS_Node._view(store, index[opening._index])
     
     def find_node(self, game_state):
         """
@@ -314,11 +887,15 @@ class MCTS_Node:
         game_state : the current state of the board (pieces, players, etc)
         modified_rules : optional arg for if modified ruleset is being used
 
-        return -> the new node being expanded to
+        return -> the new node being expanded to (or the existing node, if the position is already in the tree)
         """
 
-        new_node = MCTS_Node(game_state, self._next_turn, self._level+1, parent=self, modified_rules=modified_rules)
-        self._children.append(new_node)
+        new_node = self._table.get(game_state.position_key(self._next_turn), NO_NODE)
+        if new_node == NO_NODE:
+            new_node = MCTS_Node(game_state, self._next_turn, self._level+1, parent=self, modified_rules=modified_rules)
+        else:
+            new_node = MCTS_Node._view(self._store, new_node)
+        self._store.add_edge(self._index, new_node._index)  # The move is not known, so the node is not in the child index
         return new_node
     
     def go_back_to_root(self): 
@@ -332,3 +909,54 @@ class MCTS_Node:
             self._parent.go_back_to_root()  # Backprop
         else:
             return self
+
+
+def ucb1(net_wins, visits, parent_visits, C):
+    """
+    Upper Confidence Bound of a set of children, as one vectorized expression
+
+    net_wins : array, wins minus losses of each child (for the player who made the move to the child)
+    visits : array, visits of each child
+    parent_visits : visits of the parent
+    C : exploration parameter
+
+    return -> array of weights, unvisited children get infinity so they are always tried first
+    """
+
+    visited = visits > 0
+    safe_visits = np.where(visited, visits, 1)
+    weights = net_wins / safe_visits + C * np.sqrt(2 * np.log(max(parent_visits, 1)) / safe_visits)
+    return np.where(visited, weights, np.inf)
+
+
+def _grow_root_tree(game, turn, level, modified_rules, num_games, C, rollouts_per_leaf, seed, stateless=False, max_nodes=None,
+                    time_limit=None, early_stop=False, widening=None, symmetric=False, rollout_depth=None):
+    """
+    Worker for the root parallel search: grows an independent tree from the given position
+
+    game : the position to search from
+    turn : the player who made the last move
+    level : the level of the position
+    modified_rules : optional arg for if modified ruleset is being used
+    num games : number of nodes to expand
+    C : exploration parameter
+    rollouts_per_leaf : number of games to simulate from each new node
+    seed : random seed of this worker
+    stateless : if the worker's tree is state-free
+    max_nodes : optional node budget of the worker's tree
+    time_limit : optional number of seconds to search for
+    early_stop : stop once the most visited child can't be overtaken in the remaining iterations
+    widening : optional (k, alpha) for progressive widening
+    symmetric : if the worker's tree merges symmetric moves
+    rollout_depth : optional number of plies after which rollouts are scored by the static evaluator
+
+    return -> root visits, root results, and (move, visits, results) of every child
+    """
+
+    random.seed(seed)
+    root = MCTS_Node(game, turn, level, modified_rules=modified_rules, stateless=stateless, symmetric=symmetric)
+    root._search(num_games, C, rollouts_per_leaf, max_nodes=max_nodes, time_limit=time_limit, early_stop=early_stop,
+                 widening=widening, rollout_depth=rollout_depth)
+    store = root._store
+    return root._num_visits, root._results, [(placement_move(store.edge_move[edge]), int(store.visits[store.edge_child[edge]]),
+                                              store.results(store.edge_child[edge])) for edge in store.edges(root._index)]
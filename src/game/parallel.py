@@ -0,0 +1,57 @@
+"""
+Persistent process pools shared by the parallel search modes
+"""
+
+import atexit
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import util
+
+_POOLS = {}  # Worker count -> pool, pools are kept alive between moves and games (each process has its own)
+
+
+def get_pool(workers):
+    """
+    Returns a process pool with the given number of workers, creating it on first use
+
+    workers : number of worker processes
+
+    return -> the pool
+    """
+
+    if workers not in _POOLS:
+        pool = _POOLS[workers] = ProcessPoolExecutor(max_workers=workers)
+        # A pool worker skips atexit and joins its own children when it exits, a pool it started (a parallel
+        # search inside a parallel tournament) has to be shut down before that, and before the finalizers of the
+        # pool's queues (priority 10) stop the threads that send the shutdown to its workers
+        util.Finalize(pool, pool.shutdown, kwargs={'cancel_futures': True}, exitpriority=100)
+    return _POOLS[workers]
+
+
+def shutdown_pools():
+    """
+    Shuts down every pool (called automatically at exit)
+
+    return -> None
+    """
+
+    for pool in _POOLS.values():
+        pool.shutdown(cancel_futures=True)
+    _POOLS.clear()
+
+
+def split_work(total, workers):
+    """
+    Splits an amount of work as evenly as possible
+
+    total : the amount of work
+    workers : number of workers
+
+    return -> list of the amount of work for each worker
+    """
+
+    return [total // workers + (1 if i < total % workers else 0) for i in range(workers)]
+
+
+atexit.register(shutdown_pools)
+os.register_at_fork(after_in_child=_POOLS.clear)  # A forked worker can't use its parent's pools, it starts its own
@@ -0,0 +1,198 @@
+"""
+Rollouts: random games from one position.
+A rollout can be stopped after a number of plies, the position is then scored by a static evaluator
+"""
+
+import random
+
+import numpy as np
+
+from bitboard import TOTAL_SQUARES
+from board import PLACEMENT_MASKS, STARTING_SCORE, placement_move
+from game import Game, next_player, is_cathedral_turn
+
+# Squares covered by every placement of the placement table, for the reach feature of the static evaluator
+PLACEMENT_SQUARES = np.array([[(mask >> sq) & 1 for sq in range(TOTAL_SQUARES)] for mask in PLACEMENT_MASKS], dtype=bool)
+
+# Static evaluator weights, from fit_static_weights() with its defaults (rounded). The features are the red minus
+# black differences of: score lead (as a share of the starting score), territory and reach (squares some legal
+# placement still covers), both as a share of the board
+_SCORE_WEIGHT = 4.06
+_TERRITORY_WEIGHT = 1.36
+_REACH_WEIGHT = 0.98
+
+
+def _static_value(score_lead, territory, reach):
+    """
+    Combines the evaluator features into an estimated result
+
+    score_lead : black score minus red score (lower score wins)
+    territory : red minus black controlled squares
+    reach : red minus black squares covered by a legal placement
+
+    return -> value in [-1, 1] (scalar or array like the inputs), positive when red is ahead
+    """
+
+    value = (_SCORE_WEIGHT * score_lead / STARTING_SCORE + _TERRITORY_WEIGHT * territory / TOTAL_SQUARES +
+             _REACH_WEIGHT * reach / TOTAL_SQUARES)
+    return np.clip(value, -1.0, 1.0)
+
+
+def static_evaluation(game):
+    """
+    Cheap estimate of the result of a random rollout from a position, reuses the legal placements of the turn cache
+
+    game : the position to score
+
+    return -> the winner if the game is over (1 for red, -1 for black, 0 for a tie), otherwise a value in [-1, 1]
+    """
+
+    if game.game_over():
+        return game.winner
+    return float(_static_value(*_static_features(game)))
+
+
+def _static_features(game):
+    """
+    Features of the static evaluator (see _static_value)
+
+    game : the position
+
+    return -> (score lead, territory, reach) differences, red minus black
+    """
+
+    board = game.game_board
+    red_reach, black_reach = (int(PLACEMENT_SQUARES[game.legal_placement_ids(player)].any(axis=0).sum()) for player in (1, 2))
+    territory = board._territory[0].bit_count() - board._territory[1].bit_count()
+    return game.black_player.score - game.red_player.score, territory, red_reach - black_reach
+
+
+def fit_static_weights(num_positions=4000, seed=0, modified_rules=None):
+    """
+    Refits the static evaluator weights: every position is a random game stopped after 4 to 30 plies, scored by one
+    random rollout, and the weights are the least squares fit of the results on the features (unfinished positions only)
+
+    num_positions : number of random games to play
+    seed : random seed (the state of the random module is restored afterwards)
+    modified_rules : optional arg to specify if the modified ruleset is used
+
+    return -> (score, territory, reach) weights, for _SCORE_WEIGHT, _TERRITORY_WEIGHT and _REACH_WEIGHT
+    """
+
+    state = random.getstate()
+    random.seed(seed)
+    features, results = [], []
+    for _ in range(num_positions):
+        game = Game(modified_rules=modified_rules)
+        turn, level = 1, 0
+        for _ in range(random.randint(4, 30)):
+            if game.game_over():
+                break
+            turn = next_player(turn, level, modified_rules)
+            placement = game.random_placement(turn, is_cathedral_turn(level, modified_rules))
+            if placement is not None:
+                game.apply_move(placement_move(placement), turn)
+            level += 1
+        if game.game_over():
+            continue
+        features.append(_static_features(game))
+        results.append(random_rollout(game, turn, level, modified_rules))
+    random.setstate(state)
+
+    scaled = np.array(features, dtype=np.float64) / np.array([STARTING_SCORE, TOTAL_SQUARES, TOTAL_SQUARES])
+    weights, *_ = np.linalg.lstsq(scaled, np.array(results, dtype=np.float64), rcond=None)
+    return tuple(weights.tolist())
+
+
+def run_rollouts(game, turn, level, seeds, modified_rules=None, max_plies=None):
+    """
+    Simulates one random game per seed from the given position with random_rollout
+    (the state of the random module is restored afterwards)
+
+    game : the start position (not modified)
+    turn : the player who made the last move (1 or 2)
+    level : the level of the start position
+    seeds : one random seed per simulated game
+    modified_rules : optional arg to specify if the modified ruleset is used
+    max_plies : optional number of plies after which the games are scored by the static evaluator
+
+    return -> list of winners (1 for red, -1 for black, 0 for a tie), results in [-1, 1] if max_plies is set
+    """
+
+    state = random.getstate()
+    results = []
+    for seed in seeds:
+        random.seed(seed)
+        results.append(random_rollout(game, turn, level, modified_rules, max_plies=max_plies))
+    random.setstate(state)
+    return results
+
+
+def random_rollout(game, turn, level, modified_rules=None, rollout_policy=None, max_plies=None):
+    """
+    Simulates the rest of the game from the given position, in place (every move is undone once the game is over)
+
+    game : the start position
+    turn : the player who made the last move (1 or 2)
+    level : the level of the start position
+    modified_rules : optional arg to specify if the modified ruleset is used
+    rollout_policy : picks the move to play from a list of potential moves, None draws a uniformly random
+    legal move without listing the moves (see Game.random_placement)
+    max_plies : optional number of plies after which the game is stopped and scored by static_evaluation
+
+    return -> the simulated game's winner (1 for red, -1 for black, 0 for a tie), or a value in [-1, 1] if it was stopped
+    """
+
+    history = []  # Undo records of the simulated moves
+    stop_level = None if max_plies is None else level + max_plies
+
+    while True:
+        if level == stop_level:
+            result = static_evaluation(game)  # Stopped early, estimate the result before the moves are undone
+            break
+
+        turn = next_player(turn, level, modified_rules)
+        cathedral_turn = is_cathedral_turn(level, modified_rules)
+
+        if rollout_policy is None:
+            # A player with a legal move and both scores above 0 means the game goes on, no full scan is needed
+            placement = game.random_placement(turn, cathedral_turn)
+            if placement is not None and game.red_player.score and game.black_player.score:
+                history.append(game.apply_move(placement_move(placement), turn))
+                level += 1
+                continue
+
+        # One scan gives the game over check and the potential moves for the current player
+        turn_state = game.turn_state(turn if rollout_policy else None, cathedral_turn)
+        if turn_state.is_over:
+            result = turn_state.winner
+            break
+
+        # If the current player can make a move, if not flip to the other player/end the game
+        if turn_state.moves:
+            history.append(game.apply_move(rollout_policy(turn_state.moves), turn))
+
+        # Go to the next 'level' (next order of potential moves)
+        level += 1
+
+    for record in reversed(history):
+        game.undo(record)  # Restore the start position
+
+    return result
+
+
+def rollout_worker(position, turn, level, modified_rules, seeds, max_plies=None):
+    """
+    Worker for the leaf parallel search: simulates one game per seed from a serialized position
+
+    position : the start position, from Game.serialize
+    turn : the player who made the last move (1 or 2)
+    level : the level of the start position
+    modified_rules : optional arg to specify if the modified ruleset is used
+    seeds : one random seed per simulated game
+    max_plies : optional number of plies after which the games are scored by the static evaluator
+
+    return -> list of winners (1 for red, -1 for black, 0 for a tie), results in [-1, 1] if max_plies is set
+    """
+
+    return run_rollouts(Game.deserialize(position), turn, level, seeds, modified_rules, max_plies)
@@ -5,11 +5,24 @@ Simulates games of Cathedral
 import random
 import json
 import datetime
-import copy
 import math
+import os
+import pickle
+import time
+import traceback
 
-from game import Game
+import numpy as np
+
+from game import Game, next_player, is_cathedral_turn
 from mcts import MCTS_Node
+from board import rotate_move
+from parallel import get_pool
+import tree_io
+
+RESULTS_PATH = 'sim_results.txt'  # Default file the match results are appended to (relative to the working directory)
+_PROGRESS_BATCH = 100  # Iterations between checks of the checkpoint interval
+_TOURNAMENT_CHUNK = 4  # Games per task of the tournament runner, small enough to balance the workers
+_WORKER_PLAYERS = {}  # Tournament worker cache, (player configuration, seed) -> pickled snapshot of the players built by this process
 
 
 class Tree:
@@ -18,17 +31,131 @@ class Tree:
 
     num_games : number of games (new nodes) to precompute the tree with
     C : exploration paramter
-    n_expansion_per_turn : number of new nodes to simulate per tree turn
+    n_expansion_per_turn : number of new nodes to simulate per tree turn, None to search until time_per_move
     modified_rules : optional arg to specify if tree should be using modified ruleset
+    rollouts_per_leaf : number of games to simulate from each new node
+    workers : number of processes used by the search (root parallel when more then 1)
+    rollout_workers : number of processes the rollouts of each new node are split over (leaf parallel when more then 1)
+    stateless : if true the nodes don't keep their game (much less memory, positions are rebuilt from the moves)
+    root : optional precomputed root (see load_tree), num_games is ignored when given
+    prune : if true the played node becomes the search root after every move and the rest of the tree is freed
+    (the statistics under the played line are kept), memory stays flat over many games
+    opening_depth : with prune, number of levels below the root that are kept across moves and games
+    max_nodes : optional node budget of the tree, the least visited leaves are evicted when it is reached
+    time_per_move : optional number of seconds the tree searches per turn (with n_expansion_per_turn, the first limit reached)
+    early_stop : end a turn's search once the most visited child can't be overtaken
+    widening : optional (k, alpha), progressive widening of the search (see MCTS_Node.best_action)
+    symmetric : if true moves that are rotations of each other on a symmetric position share one node (see MCTS_Node),
+    the tree is turned to follow the game (rotation)
+    rollout_depth : optional number of plies after which rollouts are scored by the static evaluator (see MCTS_Node.best_action)
+    evaluator : optional leaf evaluator used instead of rollouts (see evaluator.py), leaves are scored eval_batch at a time
     """
 
-    def __init__(self, num_games, C, n_expansion_per_turn, modified_rules=None):
-        self.root = tree_expansion(num_games, C, modified_rules=modified_rules)
+    def __init__(self, num_games, C, n_expansion_per_turn, modified_rules=None, rollouts_per_leaf=1, workers=1, rollout_workers=1,
+                 stateless=False, root=None, prune=False, opening_depth=0, max_nodes=None, time_per_move=None, early_stop=False,
+                 widening=None, symmetric=False, rollout_depth=None, evaluator=None, eval_batch=8):
+        if root is None:
+            root = tree_expansion(num_games, C, modified_rules=modified_rules, rollouts_per_leaf=rollouts_per_leaf, workers=workers,
+                                  rollout_workers=rollout_workers, stateless=stateless, max_nodes=max_nodes, widening=widening,
+                                  symmetric=symmetric, rollout_depth=rollout_depth, evaluator=evaluator, eval_batch=eval_batch)
+        self.root = root
         self.tree = self.root
+        self.rotation = 0  # Quarter turns clockwise from the game being played to the tree
         self.C = C
         self.elo = 1000
         self.sims_per_turn = n_expansion_per_turn
         self.modified_rules = modified_rules
+        self.rollouts_per_leaf = rollouts_per_leaf
+        self.workers = workers
+        self.rollout_workers = rollout_workers
+        self.prune = prune
+        self.opening_depth = opening_depth
+        self.max_nodes = max_nodes
+        self.time_per_move = time_per_move
+        self.early_stop = early_stop
+        self.widening = widening
+        self.rollout_depth = rollout_depth
+        self.evaluator = evaluator
+        self.eval_batch = eval_batch
+
+    def choose_move(self):
+        """
+        Searches from the current node and picks the move to play
+
+        return -> the move, (piece, squares), in the orientation of the game being played
+        """
+
+        best_node = self.tree.best_action(self.sims_per_turn, self.C, self.rollouts_per_leaf, self.workers, self.rollout_workers,
+                                          self.max_nodes, self.time_per_move, self.early_stop, self.widening,
+                                          self.rollout_depth, self.evaluator, self.eval_batch)
+        return rotate_move(self.tree.move_to(best_node), -self.rotation)
+
+    def play(self, move):
+        """
+        Follows a played move, creating the node if it isn't in the game tree yet
+
+        move : the move that was played, (piece, squares)
+
+        return -> None
+        """
+
+        self.tree, self.rotation = self.tree.follow(move, self.rotation)
+        if self.prune:
+            self.tree, self.root = self.tree.prune(opening=self.root, opening_depth=self.opening_depth)
+
+    def new_game(self):
+        """
+        Goes back to the root for a new game, with prune only the opening levels of the tree are kept
+
+        return -> None
+        """
+
+        if self.prune:
+            self.root, _ = self.root.prune(self.opening_depth)
+        self.tree = self.root
+        self.rotation = 0
+
+    def save_tree(self, path):
+        """
+        Saves the tree (from the root) to a file, see tree_io.py
+
+        path : the file to write
+
+        return -> number of nodes saved
+        """
+
+        return tree_io.save_tree(self.root, path, self.C)
+
+
+def load_tree(path, n_expansion_per_turn, rollouts_per_leaf=1, workers=1, rollout_workers=1, prune=False, opening_depth=0, max_nodes=None,
+              time_per_move=None, early_stop=False, widening=None, rollout_depth=None, evaluator=None, eval_batch=8):
+    """
+    Opens a tree saved with Tree.save_tree, the ruleset and C come from the file and the nodes
+    are only read as the tree is explored
+
+    path : the saved tree
+    n_expansion_per_turn : number of new nodes to simulate per tree turn, None to search until time_per_move
+    rollouts_per_leaf : number of games to simulate from each new node
+    workers : number of processes used by the search
+    rollout_workers : number of processes the rollouts of each new node are split over
+    prune : free the rest of the tree after every move (see Tree)
+    opening_depth : with prune, number of levels below the root kept across moves and games
+    max_nodes : optional node budget of the tree
+    time_per_move : optional number of seconds the tree searches per turn
+    early_stop : end a turn's search once the most visited child can't be overtaken
+    widening : optional (k, alpha), progressive widening of the search
+    rollout_depth : optional number of plies after which rollouts are scored by the static evaluator
+    evaluator : optional leaf evaluator used instead of rollouts (see evaluator.py)
+    eval_batch : number of leaves scored per evaluator call
+
+    return -> the Tree
+    """
+
+    root, tree_file = tree_io.load_tree(path)
+    return Tree(0, tree_file.C, n_expansion_per_turn, modified_rules=tree_file.modified_rules, rollouts_per_leaf=rollouts_per_leaf,
+                workers=workers, rollout_workers=rollout_workers, stateless=True, root=root, prune=prune, opening_depth=opening_depth,
+                max_nodes=max_nodes, time_per_move=time_per_move, early_stop=early_stop, widening=widening,
+                symmetric=tree_file.symmetric, rollout_depth=rollout_depth, evaluator=evaluator, eval_batch=eval_batch)
 
 
 class Random_Player:
@@ -41,14 +168,31 @@ class Random_Player:
         self.tree = None
         self.elo = 1000
 
+    def play(self, move):
+        """
+        Random players don't keep a tree
+
+        move : the move that was played
+
+        return -> None
+        """
+
+    def new_game(self):
+        """
+        Random players don't keep a tree
+
+        return -> None
+        """
+
 
-def simulate_games(games_to_sim, p1, p2, modified_rules=None):
+def simulate_games(games_to_sim, p1, p2, modified_rules=None, results_path=RESULTS_PATH):
     """
     Simulate n games for all input trees using given C
 
     p1 : the red player, either a tree or a random player
     p2 : the black player, either a tree or a random player
     modified_rules : optional arg to specify if tree should be using modified ruleset
+    results_path : the file the results are appended to
 
     return -> None, writes results dict to a file
     """
@@ -67,15 +211,124 @@ def simulate_games(games_to_sim, p1, p2, modified_rules=None):
         print(f"Winner: {winner}")
 
         # Reset trees to root
-        p1.tree = p1.root
-        p2.tree = p2.root
+        p1.new_game()
+        p2.new_game()
 
         p1.elo, p2.elo = elo(p1.elo, p2.elo, 20, winner)
         print(f"P1: {p1.elo}")
         print(f"P2: {p2.elo}")
 
-    # save results to a file
-    f = open('sim_results.txt', "a")
+    save_results(results, results_path)
+
+def tournament(games_to_sim, make_p1, make_p2, workers, modified_rules=None, seed=0, games=None, elos=(1000, 1000), report=print,
+               results_path=RESULTS_PATH):
+    """
+    Plays the games of simulate_games on a process pool. Every worker builds the two players once (make_p1() and
+    make_p2(), seeded from seed) and keeps a pickled snapshot of them, every game starts from a fresh copy of the snapshot so the
+    searches of earlier games don't carry over. Game i is seeded from (seed, i) and p1 plays red in the even games
+    and black in the odd ones, so the results don't depend on the number of workers and a failed game replays exactly
+    (the players must be picklable, a tree opened with load_tree pickles as its file path). The traceback of every
+    failed game is passed to report
+
+    games_to_sim : number of games
+    make_p1/make_p2 : picklable functions building the two players (for example functools.partial(load_tree, ...))
+    workers : number of worker processes
+    modified_rules : optional arg to specify if the modified ruleset is used
+    seed : tournament seed, the seed of every game is derived from it
+    games : optional list of game numbers to play instead of all of them (to rerun failed games)
+    elos : starting elo of p1 and p2
+    report : called with a progress message after every finished task
+    results_path : the file the results are appended to
+
+    return -> (results dict from p1's point of view (1 for a p1 win, -1 for a p2 win, 0 for a tie),
+    (p1 elo, p2 elo), list of the game numbers that failed)
+    """
+
+    game_ids = list(range(games_to_sim)) if games is None else sorted(games)
+    key = pickle.dumps((make_p1, make_p2, modified_rules))
+    pool = get_pool(workers)
+    chunks = [game_ids[start:start + _TOURNAMENT_CHUNK] for start in range(0, len(game_ids), _TOURNAMENT_CHUNK)]
+    futures = [pool.submit(_tournament_worker, key, chunk, seed) for chunk in chunks]
+
+    outcomes = {}
+    for chunk, future in zip(chunks, futures):
+        try:
+            chunk_outcomes, errors = future.result()
+        except Exception:
+            # The worker itself failed (for example it was killed)
+            chunk_outcomes = dict.fromkeys(chunk)
+            errors = {chunk[0]: traceback.format_exc()}
+        outcomes.update(chunk_outcomes)
+        for game_id, error in errors.items():
+            report(f"game {game_id} failed:\n{error}")
+        report(f"{len(outcomes)}/{len(game_ids)} games played")
+
+    # Merge in game order, so the elo updates don't depend on which worker finished first
+    results = {1: 0, -1: 0, 0: 0}
+    elo_1, elo_2 = elos
+    failed = []
+    for game_id in game_ids:
+        outcome = outcomes[game_id]
+        if outcome is None:
+            failed.append(game_id)
+            continue
+        results[outcome] += 1
+        elo_1, elo_2 = elo(elo_1, elo_2, 20, outcome)
+
+    save_results(results, results_path)
+    return results, (elo_1, elo_2), failed
+
+def _tournament_worker(key, game_ids, seed):
+    """
+    Worker for the tournament runner: plays a list of games with the players of this process
+
+    key : the pickled (make_p1, make_p2, modified_rules), the players are built and snapshotted on first use
+    game_ids : the game numbers to play
+    seed : the tournament seed
+
+    return -> (dictionary game number -> winner from p1's point of view, None if the game failed,
+    dictionary game number -> traceback of the failed games)
+    """
+
+    make_p1, make_p2, modified_rules = pickle.loads(key)
+    if (key, seed) not in _WORKER_PLAYERS:
+        # Build the players from the tournament seed (building a tree runs a search), so every worker builds the same ones
+        random_state, np_random_state = random.getstate(), np.random.get_state()
+        random.seed(seed)
+        np.random.seed(seed % 2**32)
+        try:
+            _WORKER_PLAYERS[key, seed] = pickle.dumps((make_p1(), make_p2()))
+        finally:
+            random.setstate(random_state)
+            np.random.set_state(np_random_state)
+
+    outcomes = {}
+    errors = {}
+    for game_id in game_ids:
+        p1, p2 = pickle.loads(_WORKER_PLAYERS[key, seed])  # Every game starts from the players as they were built
+        random.seed(seed * 2**32 + game_id)
+        try:
+            if game_id % 2 == 0:
+                outcome = sim_game(p1, p2, modified_rules=modified_rules)
+            else:
+                outcome = -sim_game(p2, p1, modified_rules=modified_rules)  # p1 plays black
+        except Exception:
+            outcome = None
+            errors[game_id] = traceback.format_exc()
+        outcomes[game_id] = outcome
+    return outcomes, errors
+
+def save_results(results, path=RESULTS_PATH):
+    """
+    Appends a results dict to a file with the date
+
+    results : the results dict
+    path : the file to append to
+
+    return -> None
+    """
+
+    f = open(path, "a")
     now = datetime.datetime.now()
     dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
     f.write(f"Results: {dt_string}")
@@ -127,22 +380,100 @@ def elo(elo_1, elo_2, k, winner):
 
     return elo_1, elo_2
 
-def tree_expansion(num_games, C, modified_rules=None):
+def tree_expansion(num_games, C, modified_rules=None, rollouts_per_leaf=1, workers=1, rollout_workers=1, stateless=False, path=None,
+                   max_nodes=None, widening=None, symmetric=False, rollout_depth=None, evaluator=None, eval_batch=8):
     """
     Build a MCT with a certain number of simulated games from the root
-    saves the tree to a file for later use
+    saves the tree to a file for later use (if a path is given)
 
     num_games : the number of games the tree should be pre-computed with
     C : hyperparameter for exploitation vs exploration
+    rollouts_per_leaf : number of games to simulate from each new node
+    workers : number of processes used by the search
+    rollout_workers : number of processes the rollouts of each new node are split over
+    stateless : if true the nodes don't keep their game (see MCTS_Node)
+    path : optional file to save the tree to (see tree_io.py)
+    max_nodes : optional node budget of the tree (see MCTS_Node.best_action)
+    widening : optional (k, alpha), progressive widening of the search
+    symmetric : if true symmetric moves share one node (see MCTS_Node)
+    rollout_depth : optional number of plies after which rollouts are scored by the static evaluator
+    evaluator : optional leaf evaluator used instead of rollouts (see evaluator.py)
+    eval_batch : number of leaves scored per evaluator call
 
     return -> the root of the tree
     """
 
     # Intialize the blank node and game
     cathedral = Game(modified_rules=modified_rules)
-    root = MCTS_Node(cathedral, 1, 0, modified_rules=modified_rules) 
+    root = MCTS_Node(cathedral, 1, 0, modified_rules=modified_rules, stateless=stateless, symmetric=symmetric)
+
+    root.best_action(num_games, C, rollouts_per_leaf, workers, rollout_workers, max_nodes, widening=widening, rollout_depth=rollout_depth,
+                     evaluator=evaluator, eval_batch=eval_batch)
+    if path is not None:
+        tree_io.save_tree(root, path, C)
 
-    root.best_action(num_games, C)
+    return root
+
+def build_tree(path, target_games, C=None, modified_rules=None, checkpoint_every=1000, checkpoint_seconds=600, rollouts_per_leaf=1,
+               workers=1, rollout_workers=1, source=None, max_nodes=None, widening=None, symmetric=False, rollout_depth=None,
+               report=print):
+    """
+    Grows a saved tree until its root has been visited target_games times, checkpointing to the file as it goes.
+    If the file exists the job resumes from it, so rerunning an interrupted job continues from its last checkpoint
+    and rerunning with a larger target keeps adding simulations to a finished tree
+
+    path : the tree file, read if it exists and rewritten at every checkpoint (see tree_io.py)
+    target_games : number of simulated games the root should have
+    C : exploration parameter, defaults to the one saved with the tree (required for a new tree)
+    modified_rules : optional arg to specify if a new tree should use the modified ruleset (saved trees keep theirs)
+    checkpoint_every : number of iterations between checkpoints
+    checkpoint_seconds : maximum number of seconds between checkpoints
+    rollouts_per_leaf : number of games to simulate from each new node
+    workers : number of processes used by the search
+    rollout_workers : number of processes the rollouts of each new node are split over
+    source : optional saved tree to start from when the file does not exist yet (it is not modified)
+    max_nodes : optional node budget of the tree (see MCTS_Node.best_action)
+    widening : optional (k, alpha), progressive widening of the search
+    symmetric : if a new tree merges symmetric moves (see MCTS_Node)
+    rollout_depth : optional number of plies after which rollouts are scored by the static evaluator
+    report : called with a progress message after every checkpoint
+
+    return -> the root of the tree (MCTS_Node)
+    """
+
+    start = path if os.path.exists(path) else source
+    if start is not None:
+        root, tree_file = tree_io.load_tree(start)
+        C = tree_file.C if C is None else C
+    else:
+        if C is None:
+            raise ValueError("C is required to build a new tree")
+        root = MCTS_Node(Game(modified_rules=modified_rules), 1, 0, modified_rules=modified_rules, stateless=True, symmetric=symmetric)
+
+    store = root._store
+    batch = max(1, min(checkpoint_every, _PROGRESS_BATCH))
+    games = int(store.visits[root._index])
+    started = last_checkpoint = time.monotonic()
+    iterations = since_checkpoint = 0
+    while games < target_games:
+        # Search in small batches so the time limit is checked regularly
+        count = min(batch, checkpoint_every - since_checkpoint, math.ceil((target_games - games) / rollouts_per_leaf))
+        root.best_action(count, C, rollouts_per_leaf, workers, rollout_workers, max_nodes, widening=widening,
+                         rollout_depth=rollout_depth)
+        games = int(store.visits[root._index])
+        iterations += count
+        since_checkpoint += count
+
+        now = time.monotonic()
+        if since_checkpoint >= checkpoint_every or now - last_checkpoint >= checkpoint_seconds or games >= target_games:
+            # Write a temporary file then rename it, an interrupted write never corrupts the last checkpoint
+            temporary = path + '.tmp'
+            num_nodes = tree_io.save_tree(root, temporary, C)
+            os.replace(temporary, path)
+            last_checkpoint = time.monotonic()
+            since_checkpoint = 0
+            report(f"{games}/{target_games} games, {iterations / (now - started):.1f} iterations/s, {num_nodes} nodes, "
+                   f"{store.evicted} evicted, saved {path}")
 
     return root
 
@@ -156,7 +487,7 @@ def sim_game(p1, p2, modified_rules=None):
     
     return -> the winner of the game
     """
-    sim = Game()
+    sim = Game(modified_rules=modified_rules)
     p1_type = 'Tree' if isinstance(p1.tree, MCTS_Node) else 'Random'
     p2_type = 'Tree' if isinstance(p2.tree, MCTS_Node) else 'Random'
 
@@ -168,72 +499,36 @@ def sim_game(p1, p2, modified_rules=None):
         current_player = sim.red_player if turn == 1 else sim.black_player
 
         # Get potential moves for the current player
-        cathedral_turn = True if (modified_rules and level == 1) or (not modified_rules and level == 0) else None
+        cathedral_turn = is_cathedral_turn(level, modified_rules)
         potential_moves = sim.get_potential_moves(current_player, cathedral_turn=cathedral_turn)
 
         # If the current player can make a move, if not flip to the other player/end the game
         if potential_moves: 
             if turn == 1:
                 if p1_type == 'Tree':
-                    # Update sim to be a copy of the tree's next best action 
-                    # This is equivelent to making a move for the tree player
-                    sim = copy.deepcopy(p1.tree.best_action(p1.sims_per_turn, p1.C)._game)
+                    # The tree's next best action is the move for the tree player
+                    move_selected = p1.choose_move()
 
                 elif p1_type == 'Random':
                     move_selected = random.choice(potential_moves)  # choose a random move to make
-                    piece_selected = move_selected[0] 
-                    sim.use_piece(turn, piece_selected) 
-
-                    # Update the board
-                    returned_pieces = sim.game_board.update(move_selected[1], turn, move_selected[0])
-                    if returned_pieces:
-                        sim.return_piece(turn, returned_pieces[0])
 
             elif turn == 2:
                 if p2_type == 'Tree':
-                    # Update sim to be a copy of the tree's next best action 
-                    # This is equivelent to making a move for the tree player
-                    sim = copy.deepcopy(p2.tree.best_action(p2.sims_per_turn, p2.C)._game)
+                    # The tree's next best action is the move for the tree player
+                    move_selected = p2.choose_move()
 
                 elif p2_type == 'Random':
                     move_selected = random.choice(potential_moves)  # choice a random move to make
-                    piece_selected = move_selected[0] 
-                    sim.use_piece(turn, piece_selected) 
-
-                    # Update the board
-                    returned_pieces = sim.game_board.update(move_selected[1], turn, move_selected[0])
-                    if returned_pieces:
-                       sim.return_piece(turn, returned_pieces[0])
-
-        # Trees need to be set to the new game state once the other player makes a move
-        if p1_type == 'Tree':
-            # Try to find the new game state in the game tree
-            next_node = p1.tree.find_node(sim)
-            if next_node:
-                p1.tree = next_node
-            else:
-                # If the game state isn't in the game tree, expand the game tree so that it is
-                p1.tree = p1.tree.expand_specific_node(copy.deepcopy(sim), modified_rules=modified_rules)
-
-        if p2_type == 'Tree':
-            # Try to find the new game state in the game tree
-            next_node = p2.tree.find_node(sim)
-            if next_node:
-                p2.tree = next_node
-            else: 
-                # If the game state isn't in the game tree, expand the game tree so that it is
-                p2.tree = p2.tree.expand_specific_node(copy.deepcopy(sim), modified_rules=modified_rules)
+
+            sim.apply_move(move_selected, turn)
+
+            # Trees follow the move that was played, creating the node if it isn't in the game tree yet
+            p1.play(move_selected)
+            p2.play(move_selected)
 
         # Go to the next 'level' (next order of potential moves)
         level+=1
-
-        if modified_rules and level == 2:
-            turn = 2
-        # Under normal rules, red places first cathedral then first piece
-        elif not modified_rules and level == 1:
-            turn = 1
-        else:
-            turn = 1 if turn == 2 else 2
+        turn = next_player(turn, level, modified_rules)
 
     return sim.winner  # Once a winner is found, end simulation
 
@@ -0,0 +1,19 @@
+"""
+Tests of the tournament runner
+"""
+
+import functools
+
+from sim import tournament, Tree, Random_Player
+
+
+def test_tournament_reproducible_across_workers(tmp_path):
+    """
+    The same seed gives the same results with one and two workers, including the players the workers build
+    """
+
+    make_p1 = functools.partial(Tree, 20, 1.4, 5)
+    runs = [tournament(8, make_p1, Random_Player, workers, seed=7, report=lambda message: None,
+                       results_path=tmp_path / 'sim_results.txt') for workers in (1, 2, 1, 2)]
+    assert all(run == runs[0] for run in runs)
+    assert runs[0][2] == []
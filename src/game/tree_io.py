@@ -0,0 +1,220 @@
+"""
+Compact binary files for precomputed trees
+
+File layout (little endian, every array starts on an 8 byte boundary):
+    header : magic, format version, flags (ruleset, symmetric tree), C, node/edge counts, root turn/level and the root position (Game.serialize)
+    node arrays (one entry per node) : visits, wins, losses, ties, position hash, side, next side, level
+    child_offsets : the children of node i are entries child_offsets[i]:child_offsets[i+1] of the edge arrays
+    edge arrays (one entry per edge) : child node, move (placement id)
+
+Node 0 is the root. A loaded tree is memory-mapped and only the nodes the search or sim_game
+reaches are copied into the tree store (see TreeFile.materialize), so opening even a very large tree is instant
+"""
+
+import struct
+
+import numpy as np
+
+from game import Game
+from mcts import MCTS_Node
+from tree_store import TreeStore, NO_NODE
+
+FORMAT_VERSION = 1
+_MAGIC = b'CTRE'
+_HEADER = struct.Struct('<4sHBxdQQhBxH')  # magic, version, flags, C, nodes, edges, root level, root turn, position size
+_MODIFIED_RULES = 1  # Header flags
+_SYMMETRIC = 2
+
+# (name, dtype) of the node and edge arrays, in file order
+_NODE_ARRAYS = (('visits', np.int64), ('wins', np.float64), ('losses', np.float64), ('ties', np.float64),
+                ('key', np.uint64), ('side', np.int8), ('next_side', np.int8), ('level', np.int16))
+_EDGE_ARRAYS = (('child_nodes', np.int32), ('child_moves', np.int16))
+
+
+def _padding(offset):
+    """
+    Number of bytes to the next 8 byte boundary
+
+    offset : the current file offset
+
+    return -> number of padding bytes
+    """
+
+    return -offset % 8
+
+
+def save_tree(root, path, C):
+    """
+    Writes the tree below a node to a file, the node becomes the root of the saved tree
+    (edges without a known move are skipped, a lazily loaded tree is read completely first)
+
+    root : the root node (MCTS_Node)
+    path : the file to write
+    C : the exploration parameter the tree was built with
+
+    return -> number of nodes written
+    """
+
+    store = root._store
+
+    # Number the nodes breadth first, a node reached by several moves is written once
+    file_ids = {root._index: 0}
+    order = [root._index]
+    offsets = [0]
+    child_nodes, child_moves = [], []
+    for node in order:
+        for edge in store.edges(node).tolist():
+            move = store.edge_move[edge]
+            if move == NO_NODE:
+                continue
+            child = int(store.edge_child[edge])
+            if child not in file_ids:
+                file_ids[child] = len(order)
+                order.append(child)
+            child_nodes.append(file_ids[child])
+            child_moves.append(move)
+        offsets.append(len(child_nodes))
+
+    keys = {node: key for key, node in store.table.items()}  # After the walk, which may have loaded more nodes
+    nodes = np.array(order, dtype=np.int64)
+    arrays = {
+        'visits': store.visits[nodes], 'wins': store.wins[nodes], 'losses': store.losses[nodes], 'ties': store.ties[nodes],
+        'key': np.array([keys.get(node, 0) for node in order], dtype=np.uint64),
+        'side': store.side[nodes], 'next_side': store.next_side[nodes], 'level': store.level[nodes],
+        'child_offsets': np.array(offsets, dtype=np.int64),
+        'child_nodes': np.array(child_nodes, dtype=np.int32), 'child_moves': np.array(child_moves, dtype=np.int16),
+    }
+
+    position = root._game.serialize()
+    with open(path, 'wb') as f:
+        flags = (_MODIFIED_RULES if root._modified_rules else 0) | (_SYMMETRIC if store.symmetric else 0)
+        f.write(_HEADER.pack(_MAGIC, FORMAT_VERSION, flags, C, len(order), len(child_nodes),
+                             root._level, root._turn, len(position)))
+        f.write(position)
+        offset = _HEADER.size + len(position)
+        for name, dtype in _NODE_ARRAYS + (('child_offsets', np.int64),) + _EDGE_ARRAYS:
+            f.write(b'\0' * _padding(offset))
+            offset += _padding(offset)
+            data = arrays[name].astype(dtype, copy=False).tobytes()
+            f.write(data)
+            offset += len(data)
+
+    return len(order)
+
+
+class TreeFile:
+    """
+    A saved tree opened with memory-mapped arrays
+
+    modified_rules : the ruleset the tree was built with
+    symmetric : if the tree merges symmetric moves
+    C : the exploration parameter the tree was built with
+    num_nodes/num_edges : size of the tree
+    root_game/root_turn/root_level : the root position
+    visits, wins, ... : the node and edge arrays (see the module docstring)
+    path : the opened file, a pickled TreeFile only keeps the path and maps the file again when unpickled
+    """
+
+    def __init__(self, path):
+        """
+        Reads the header and maps the arrays, nothing else is read from the file
+
+        path : the file to open
+        """
+
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            magic, version, flags, self.C, self.num_nodes, self.num_edges, self.root_level, self.root_turn, position_size = \
+                _HEADER.unpack(header)
+            if magic != _MAGIC:
+                raise ValueError(f"{path} is not a saved tree")
+            if version != FORMAT_VERSION:
+                raise ValueError(f"{path} has tree format version {version}, expected {FORMAT_VERSION}")
+            self.root_game = Game.deserialize(f.read(position_size))
+
+        self.modified_rules = True if flags & _MODIFIED_RULES else None
+        self.symmetric = bool(flags & _SYMMETRIC)
+        offset = _HEADER.size + position_size
+        sizes = [(name, dtype, self.num_nodes) for name, dtype in _NODE_ARRAYS]
+        sizes += [('child_offsets', np.int64, self.num_nodes + 1)] + [(name, dtype, self.num_edges) for name, dtype in _EDGE_ARRAYS]
+        for name, dtype, count in sizes:
+            offset += _padding(offset)
+            if count:
+                setattr(self, name, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,)))
+            else:
+                setattr(self, name, np.empty(0, dtype=dtype))
+            offset += count * np.dtype(dtype).itemsize
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def _copy_node(self, store, file_id, parent, move):
+        """
+        Copies one node (statistics, position hash) into a tree store
+
+        store : the tree store
+        file_id : the node in the file
+        parent : the store node of its parent, NO_NODE for the root
+        move : placement id of the move from the parent
+
+        return -> the store node
+        """
+
+        game = self.root_game.clone() if parent == NO_NODE else None  # Other positions are rebuilt from the moves
+        node = store.add_node(game, int(self.side[file_id]), int(self.next_side[file_id]), int(self.level[file_id]), None, parent, move)
+        store.visits[node] = self.visits[file_id]
+        store.wins[node] = self.wins[file_id]
+        store.losses[node] = self.losses[file_id]
+        store.ties[node] = self.ties[file_id]
+        store.table.setdefault(int(self.key[file_id]), node)
+        store.loaded[file_id] = node
+        if self.child_offsets[file_id + 1] > self.child_offsets[file_id]:
+            store.pending[node] = file_id
+        return node
+
+    def open_root(self):
+        """
+        Creates a state-free tree store backed by this file, holding only the root
+
+        return -> (store, root node)
+        """
+
+        store = TreeStore(self.modified_rules, stateless=True, symmetric=self.symmetric)
+        store.source = self
+        return store, self._copy_node(store, 0, NO_NODE, NO_NODE)
+
+    def materialize(self, store, node, file_id):
+        """
+        Copies the children of a node into the tree store (called by the store the first time they are needed)
+
+        store : the tree store
+        node : the store node
+        file_id : the node in the file
+
+        return -> None
+        """
+
+        start, stop = self.child_offsets[file_id], self.child_offsets[file_id + 1]
+        for file_child, move in zip(self.child_nodes[start:stop].tolist(), self.child_moves[start:stop].tolist()):
+            child = store.loaded.get(file_child)
+            if child is None:
+                child = self._copy_node(store, file_child, node, move)
+            store.add_edge(node, child, move)
+
+
+def load_tree(path):
+    """
+    Opens a saved tree, the nodes are read from the file as the tree is explored
+
+    path : the file to open
+
+    return -> (root node, TreeFile with the header values)
+    """
+
+    tree_file = TreeFile(path)
+    store, root = tree_file.open_root()
+    return MCTS_Node._view(store, root), tree_file
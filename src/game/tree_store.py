@@ -0,0 +1,405 @@
+"""
+Struct-of-arrays storage for the Monte Carlo tree
+
+Every node is an index into preallocated NumPy arrays (statistics, links, move ids), the arrays grow
+geometrically as nodes are added. The MCTS_Node objects in mcts.py are thin views over one index.
+Children are linked through edges, so a position reached by several move orders (see the transposition
+table) is a single node with several incoming edges
+"""
+
+import math
+
+import numpy as np
+
+from board import PLACEMENT_PIECES
+
+NO_NODE = -1  # Missing link, or unknown move
+NUM_PLACEMENTS = len(PLACEMENT_PIECES)
+_LINK_ARRAYS = {'parent', 'move', 'edge_child', 'edge_parent', 'edge_move'}  # Arrays whose unused entries are NO_NODE
+
+
+class TreeStore:
+    """
+    Holds every node and edge of one tree
+
+    visits : number of times each node was visited
+    wins/losses/ties : results of the simulated games through each node, wins and losses are
+    from the point of view of the player who made the move leading to the node (side)
+    parent : the first parent of each node, NO_NODE for the root
+    num_children : number of outgoing edges of each node
+    child_edges : outgoing edges of each node as a contiguous np.int32 array (grown geometrically, only the first
+    num_children entries are used), None for leaves
+    move : placement id of the move from the first parent, NO_NODE if unknown
+    side : player who made the move leading to the node (1 or 2)
+    next_side : player to move from the node (1 or 2)
+    level : the level of the node (0 for root)
+    edge_child : node each edge leads to
+    edge_parent : node each edge leaves from
+    edge_move : placement id of each edge, NO_NODE if unknown
+    games : the game of each node, None if it is rebuilt from the moves
+    untried : untried placement ids of each node (drawn at random, see MCTS_Node._draw_untried), None until listed
+    ordered : nodes whose untried moves are sorted by the priors of an evaluator, drawn from the end in order
+    table : transposition table, position hash -> node
+    child_index : parent * NUM_PLACEMENTS + placement id -> child
+    modified_rules : the ruleset used by the tree
+    stateless : if nodes reached by a known move keep no game (their entry in games is None)
+    symmetric : if nodes only expand one move of each set of moves that are rotations of each other (see MCTS_Node)
+    source : the saved tree the store was loaded from (see tree_io.py), None if built in memory
+    pending : node -> its node in the source, for loaded nodes whose children are not copied yet
+    loaded : node in the source -> node
+    free_nodes/free_edges : slots of evicted nodes and their edges, reused before the arrays grow (see evict)
+    evicted : number of nodes evicted so far
+    """
+
+    def __init__(self, modified_rules=None, stateless=False, capacity=1024, symmetric=False):
+        """
+        Allocates an empty store
+
+        modified_rules : optional arg to specify if the modified ruleset is used
+        stateless : if nodes reached by a known move keep no game
+        capacity : initial number of nodes/edges, the arrays double when full
+        symmetric : if symmetric moves are merged
+        """
+
+        self.modified_rules = modified_rules
+        self.stateless = stateless
+        self.symmetric = symmetric
+        self.num_nodes = 0
+        self.num_edges = 0
+
+        self.visits = np.zeros(capacity, dtype=np.int64)
+        self.wins = np.zeros(capacity, dtype=np.float64)
+        self.losses = np.zeros(capacity, dtype=np.float64)
+        self.ties = np.zeros(capacity, dtype=np.float64)
+        self.parent = np.full(capacity, NO_NODE, dtype=np.int32)
+        self.num_children = np.zeros(capacity, dtype=np.int32)
+        self.move = np.full(capacity, NO_NODE, dtype=np.int32)
+        self.side = np.zeros(capacity, dtype=np.int8)
+        self.next_side = np.zeros(capacity, dtype=np.int8)
+        self.level = np.zeros(capacity, dtype=np.int16)
+
+        self.edge_child = np.full(capacity, NO_NODE, dtype=np.int32)
+        self.edge_parent = np.full(capacity, NO_NODE, dtype=np.int32)
+        self.edge_move = np.full(capacity, NO_NODE, dtype=np.int32)
+
+        self.child_edges = []
+        self.games = []
+        self.untried = []
+        self.ordered = set()
+        self.table = {}
+        self.child_index = {}
+        self.source = None
+        self.pending = {}
+        self.loaded = {}
+        self.free_nodes = []
+        self.free_edges = []
+        self.evicted = 0
+
+    def _grow(self, names, size):
+        """
+        Doubles the capacity of a group of arrays
+
+        names : attribute names of the arrays
+        size : the number of entries in use
+
+        return -> None
+        """
+
+        for name in names:
+            old = getattr(self, name)
+            new = np.full(2 * len(old), NO_NODE if name in _LINK_ARRAYS else 0, dtype=old.dtype)
+            new[:size] = old[:size]
+            setattr(self, name, new)
+
+    def add_node(self, game, side, next_side, level, untried, parent=NO_NODE, move=NO_NODE):
+        """
+        Adds a node (without linking it to its parent, see add_edge)
+
+        game : the game of the node
+        side : player who made the move leading to the node
+        next_side : player to move from the node
+        level : the level of the node
+        untried : np.int16 array of untried placement ids, None to list them later
+        parent : the first parent, NO_NODE for the root
+        move : placement id of the move from the parent, NO_NODE if unknown
+
+        return -> the new node
+        """
+
+        if self.free_nodes:
+            node = self.free_nodes.pop()  # Reuse the slot of an evicted node (its statistics were cleared)
+            self.child_edges[node] = None
+            self.games[node] = game
+            self.untried[node] = untried
+        else:
+            node = self.num_nodes
+            if node == len(self.visits):
+                self._grow(('visits', 'wins', 'losses', 'ties', 'parent', 'num_children', 'move', 'side', 'next_side', 'level'), node)
+            self.child_edges.append(None)
+            self.games.append(game)
+            self.untried.append(untried)
+            self.num_nodes += 1
+
+        self.parent[node] = parent
+        self.move[node] = move
+        self.side[node] = side
+        self.next_side[node] = next_side
+        self.level[node] = level
+        return node
+
+    def add_edge(self, parent, child, move=NO_NODE):
+        """
+        Links a child to a parent
+
+        parent : the parent node
+        child : the child node
+        move : placement id of the move, NO_NODE if unknown
+
+        return -> None
+        """
+
+        if self.free_edges:
+            edge = self.free_edges.pop()
+        else:
+            edge = self.num_edges
+            if edge == len(self.edge_child):
+                self._grow(('edge_child', 'edge_parent', 'edge_move'), edge)
+            self.num_edges += 1
+
+        self.edge_child[edge] = child
+        self.edge_parent[edge] = parent
+        self.edge_move[edge] = move
+
+        # Append to the parent's edge array, doubling it when full
+        edges = self.child_edges[parent]
+        count = self.num_children[parent]
+        if edges is None or count == len(edges):
+            grown = np.empty(max(4, 2 * count), dtype=np.int32)
+            if count:
+                grown[:count] = edges
+            edges = self.child_edges[parent] = grown
+        edges[count] = edge
+        self.num_children[parent] = count + 1
+
+        if move != NO_NODE:
+            self.child_index[int(parent) * NUM_PLACEMENTS + int(move)] = int(child)
+
+    def edges(self, node):
+        """
+        Lists the outgoing edges of a node, in the order they were added
+
+        node : the node
+
+        return -> np.int32 array of edges (a view, valid until the next edge is added to the node)
+        """
+
+        if node in self.pending:
+            self.source.materialize(self, node, self.pending.pop(node))
+        edges = self.child_edges[node]
+        if edges is None:
+            return np.empty(0, dtype=np.int32)
+        return edges[:self.num_children[node]]
+
+    def children(self, node):
+        """
+        Lists the children of a node, in the order they were added
+
+        node : the node
+
+        return -> np.int32 array of nodes
+        """
+
+        edges = self.edges(node)  # May load the children (and grow the arrays), so look them up first
+        return self.edge_child[edges]
+
+    def child(self, node, move):
+        """
+        Finds the child reached by a move
+
+        node : the parent node
+        move : placement id of the move
+
+        return -> the child, NO_NODE if it is not in the tree
+        """
+
+        if node in self.pending:
+            self.source.materialize(self, node, self.pending.pop(node))
+        return self.child_index.get(int(node) * NUM_PLACEMENTS + int(move), NO_NODE)
+
+    def size(self):
+        """
+        Number of nodes in the tree (num_nodes also counts the free slots of evicted nodes)
+
+        return -> number of nodes
+        """
+
+        return self.num_nodes - len(self.free_nodes)
+
+    def stats(self):
+        """
+        Size of the tree, reported by the search
+
+        return -> dictionary: nodes, edges, evicted (number of nodes evicted so far)
+        """
+
+        return {'nodes': self.size(), 'edges': self.num_edges - len(self.free_edges), 'evicted': self.evicted}
+
+    def evict(self, count, protect=()):
+        """
+        Frees the least visited leaves to keep the tree under a node budget. Their results stay in their
+        parents (every simulation through a node is also counted in its ancestors) and their moves go back
+        to the untried moves of their parents, to be expanded again if the search returns there
+
+        count : number of leaves to free
+        protect : nodes that must not be freed (the search root)
+
+        return -> number of nodes freed
+        """
+
+        # Leaves below a root, free slots have no parent so they are never picked again
+        candidates = (self.num_children[:self.num_nodes] == 0) & (self.parent[:self.num_nodes] != NO_NODE)
+        candidates[list(protect)] = False
+        victims = np.flatnonzero(candidates)
+        if len(victims) > count:
+            victims = victims[np.argpartition(self.visits[victims], count - 1)[:count]] if count > 0 else victims[:0]
+        if len(victims) == 0:
+            return 0
+
+        # Unlink every edge leading to a victim (a transposition can have several parents)
+        for edge in np.flatnonzero(np.isin(self.edge_child[:self.num_edges], victims)).tolist():
+            parent, move = int(self.edge_parent[edge]), int(self.edge_move[edge])
+            edges = self.child_edges[parent][:self.num_children[parent]]
+            remaining = edges[edges != edge]
+            edges[:len(remaining)] = remaining
+            self.num_children[parent] = len(remaining)
+            if move != NO_NODE:
+                del self.child_index[parent * NUM_PLACEMENTS + move]
+                if self.untried[parent] is not None:
+                    # An ordered parent gets the move back as its last choice, it was already tried once
+                    moves = (np.int16(move), self.untried[parent]) if parent in self.ordered else (self.untried[parent], np.int16(move))
+                    self.untried[parent] = np.hstack(moves)
+            self.edge_child[edge] = self.edge_parent[edge] = self.edge_move[edge] = NO_NODE
+            self.free_edges.append(edge)
+
+        for name in ('visits', 'wins', 'losses', 'ties'):
+            getattr(self, name)[victims] = 0
+        self.parent[victims] = NO_NODE
+        self.move[victims] = NO_NODE
+        freed = set(victims.tolist())
+        for node in freed:
+            self.games[node] = self.untried[node] = self.child_edges[node] = None
+            self.pending.pop(node, None)
+            self.ordered.discard(node)
+        self.table = {key: node for key, node in self.table.items() if node not in freed}
+        self.loaded = {file_id: node for file_id, node in self.loaded.items() if node not in freed}
+        self.free_nodes.extend(freed)
+        self.evicted += len(freed)
+        return len(freed)
+
+    def ancestors(self, node):
+        """
+        Follows the first parents from a node up to the root
+
+        node : the node
+
+        return -> list of nodes, starting with the given node
+        """
+
+        nodes = []
+        while node != NO_NODE:
+            nodes.append(int(node))
+            node = self.parent[node]
+        return nodes
+
+    def add_results(self, nodes, counts, visits=None):
+        """
+        Adds simulation results to a set of nodes
+
+        nodes : distinct nodes to update
+        counts : results dictionary (1 for red wins, -1 for black wins, 0 for ties) -> number of games
+        visits : number of visits to add, defaults to the number of games
+
+        return -> None
+        """
+
+        nodes = np.asarray(nodes, dtype=np.int64)
+        red = self.side[nodes] == 1
+        self.visits[nodes] += sum(counts.values()) if visits is None else visits
+        self.wins[nodes] += np.where(red, counts.get(1, 0), counts.get(-1, 0))
+        self.losses[nodes] += np.where(red, counts.get(-1, 0), counts.get(1, 0))
+        self.ties[nodes] += counts.get(0, 0)
+
+    def results(self, node):
+        """
+        Results of a node in the MCTS_Node format
+
+        node : the node
+
+        return -> results dictionary, 1 for red wins, -1 for black wins, 0 for ties
+        """
+
+        wins, losses = self.wins.item(node), self.losses.item(node)
+        if self.side[node] == 1:
+            return {1: wins, -1: losses, 0: self.ties.item(node)}
+        return {1: losses, -1: wins, 0: self.ties.item(node)}
+
+    def prune(self, keep, rebuild_game):
+        """
+        Copies the part of the tree that is still needed into a new store, everything else is freed with this store.
+        A node is kept if it is within the given depth of one of the kept nodes, nodes at the depth limit lose their
+        children (their untried moves are listed again). The statistics of kept nodes are unchanged
+
+        keep : list of (node, depth), depth None keeps the whole subtree of the node
+        rebuild_game : function node -> its game, used for kept nodes that can no longer be rebuilt from a kept parent
+
+        return -> (new store, np.int64 array mapping every node of this store to its new node, NO_NODE if freed)
+        """
+
+        # Walk down from the kept nodes, a node reached several ways keeps the largest remaining depth
+        remaining = {}
+        found = {}  # Node -> (kept parent, move) it was first reached from
+        stack = [(int(node), math.inf if depth is None else depth) for node, depth in keep]
+        while stack:
+            node, depth = stack.pop()
+            if remaining.get(node, -1) >= depth:
+                continue
+            remaining[node] = depth
+            if depth == 0 or self.child_edges[node] is None:
+                continue
+            for edge in self.child_edges[node][:self.num_children[node]].tolist():
+                child = int(self.edge_child[edge])
+                found.setdefault(child, (node, int(self.edge_move[edge])))
+                stack.append((child, depth - 1))
+
+        old = np.array(sorted(remaining), dtype=np.int64)
+        index = np.full(self.num_nodes, NO_NODE, dtype=np.int64)
+        index[old] = np.arange(len(old))
+        store = TreeStore(self.modified_rules, self.stateless, capacity=max(1024, len(old)), symmetric=self.symmetric)
+        for name in ('visits', 'wins', 'losses', 'ties', 'side', 'next_side', 'level'):
+            getattr(store, name)[:len(old)] = getattr(self, name)[old]
+        store.num_nodes = len(old)
+        store.games = [self.games[node] for node in old.tolist()]
+        store.untried = [self.untried[node] if remaining[node] else None for node in old.tolist()]
+        store.ordered = {int(index[node]) for node in self.ordered if remaining.get(node, 0)}
+        store.child_edges = [None] * len(old)
+
+        for new, node in enumerate(old.tolist()):
+            # Keep the first parent if it still links to the node, otherwise any kept parent that does
+            parent, move = int(self.parent[node]), int(self.move[node])
+            if remaining.get(parent, 0) == 0:
+                parent, move = found.get(node, (NO_NODE, NO_NODE))
+            if store.games[new] is None and move == NO_NODE:
+                store.games[new] = rebuild_game(node)  # Nothing left to replay the moves from
+            store.parent[new] = index[parent] if parent != NO_NODE else NO_NODE
+            store.move[new] = move
+
+            if remaining[node] and self.child_edges[node] is not None:
+                for edge in self.child_edges[node][:self.num_children[node]].tolist():
+                    store.add_edge(new, int(index[self.edge_child[edge]]), int(self.edge_move[edge]))
+
+        store.table = {key: int(index[node]) for key, node in self.table.items() if index[node] != NO_NODE}
+        store.source = self.source
+        store.evicted = self.evicted
+        store.pending = {int(index[node]): file_id for node, file_id in self.pending.items() if remaining.get(node, 0)}
+        store.loaded = {file_id: int(index[node]) for file_id, node in self.loaded.items() if index[node] != NO_NODE}
+        return store, index
@@ -0,0 +1,26 @@
+"""
+Zobrist hashing of game positions
+
+Every feature of a position (a piece or a players control on a square, a piece count, owning the cathedral,
+the player to move) has a random 64 bit key, the hash of a position is the XOR of the keys of its features.
+Playing or undoing a move only touches the features it changes, so the hash is kept up to date incrementally
+"""
+
+import numpy as np
+
+_RNG = np.random.default_rng(0x5EED)  # Fixed seed, every process builds the same keys
+
+
+def random_keys(*shape):
+    """
+    Draws a table of random 64 bit keys (tables are drawn in import order, so the keys are the same in every process)
+
+    shape : the table dimensions
+
+    return -> nested lists of Python ints
+    """
+
+    return _RNG.integers(0, 1 << 64, size=shape, dtype=np.uint64).tolist()
+
+
+SIDE_KEYS = random_keys(3)  # Indexed by player number (1 or 2) of the player who made the last move